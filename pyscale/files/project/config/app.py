@@ -10,9 +10,26 @@ class Configuration(object):
 		self.env = os.environ.get('APP_ENV') or env
 		self.root = osp.abspath('.')
 	
+	@property
+	def registry(self):
+		# folder shared by all hosts, where modules advertise tcp endpoints
+		return osp.join(self.root, 'tmp', 'registry')
+
 	@property
 	def log_level(self):
 		if self.env == 'production':
 			return logging.WARNING
 		else:
 			return logging.DEBUG
+
+	# log rotation (bytes per file, files kept)
+	log_max_bytes = 10 << 20
+	log_backups = 5
+
+	# records buffered for the log thread, beyond that they are dropped
+	# (or the logging greenlet waits with log_block)
+	log_buffer = 10000
+	log_block = False
+
+	# 'text' or 'json' (one object per line, searchable with cake logs query)
+	log_format = 'text'
@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from pyscale.lib.module import BaseModule, job
+from pyscale.lib.module import BaseModule, job, subscribe
 
 
 class Module(BaseModule):
@@ -1,7 +1,111 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
-def api(method):
-	""" Basic decorator for module API methods """
-	method.api = True
-	return method
+import collections
+import functools
+import json
+import time
+
+__all__ = ['api', 'cached', 'Cache']
+
+
+def api(method=None, cpu=False):
+	""" Basic decorator for module API methods
+
+	@api(cpu=True) runs the method in a pool of worker processes
+	(module replicas) so cpu-bound work doesn't stall the module.
+	"""
+	def decorator(method):
+		method.api = True
+		method.cpu = cpu
+		return method
+
+	if method is None:
+		return decorator
+
+	return decorator(method)
+
+
+def cached(ttl=None, maxsize=128):
+	""" Memoize module methods by arguments (LRU, entries expire after ttl seconds)
+
+	Apply on top of @api. The cache is shared by all instances of the class
+	(there's one module per process) and returned values must not be mutated.
+	Callers reach it over rpc: sock.method.cache.stats() / .invalidate(*args).
+	"""
+	def decorator(method):
+		cache = Cache(ttl, maxsize)
+
+		@functools.wraps(method)
+		def wrapper(self, *args, **kwargs):
+			return cache.entry(cache.key(args, kwargs), lambda: method(self, *args, **kwargs))[0]
+
+		wrapper.cache = cache
+		wrapper.uncached = method
+		return wrapper
+
+	return decorator
+
+
+class Cache(object):
+	""" LRU cache of [value, expires, {codec: encoded reply}] entries """
+
+	def __init__(self, ttl=None, maxsize=128):
+		self.ttl     = ttl
+		self.maxsize = maxsize
+
+		self.entries = collections.OrderedDict()
+		self.hits    = 0
+		self.misses  = 0
+
+		# called with the invalidated key (None for all), e.g. to notify client caches
+		self.listeners = []
+
+	@staticmethod
+	def key(args, kwargs):
+		""" Serialized arguments (None if they can't be serialized) """
+		try: return json.dumps([args, kwargs], sort_keys=True)
+		except (TypeError, ValueError):
+			return None
+
+	def get(self, key):
+		""" Fresh entry for key or None """
+		entry = self.entries.pop(key, None)
+
+		if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self.entries[key] = entry
+		return entry
+
+	def put(self, key, value):
+		entry = [value, None if self.ttl is None else time.time() + self.ttl, {}]
+
+		if key is not None:
+			self.entries[key] = entry
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+		return entry
+
+	def entry(self, key, compute):
+		""" Entry for key, compute() its value on misses """
+		return self.get(key) or self.put(key, compute())
+
+	def invalidate(self, *args, **kwargs):
+		""" Drop the entry for these arguments (all entries without arguments) """
+		self.drop(self.key(args, kwargs) if args or kwargs else None)
+
+	def drop(self, key=None):
+		if key is None:
+			self.entries.clear()
+		else:
+			self.entries.pop(key, None)
+
+		for listener in self.listeners:
+			listener(key)
+
+	def stats(self):
+		return dict(hits=self.hits, misses=self.misses, size=len(self.entries), maxsize=self.maxsize, ttl=self.ttl)
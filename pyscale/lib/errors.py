@@ -38,3 +38,11 @@ class ReqError(Exception):
 
 	def __nonzero__(self):
 		return False
+
+
+class OverloadError(ReqError):
+	""" Request shed by an overloaded module (safe to retry later) """
+
+
+class DeadlineError(ReqError):
+	""" Request timed out (the module may still have executed it) """
@@ -2,10 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import atexit
+import collections
+import json
 import logging
 import logging.handlers
+import os
+import os.path as osp
 import traceback
 
+import gevent
+import gevent.monkey
+
 
 class MyFormatter(logging.Formatter):
 	def format(self, record):
@@ -13,6 +21,97 @@ class MyFormatter(logging.Formatter):
 		return logging.Formatter.format(self, record)
 
 
+class JsonFormatter(logging.Formatter):
+	""" One JSON object per line (see cake logs) """
+
+	def __init__(self, module=None):
+		logging.Formatter.__init__(self)
+		self.module = module
+
+	def format(self, record):
+		entry = dict(time=record.created, module=self.module, level=record.levelname, levelno=record.levelno,
+				file=record.filename, line=record.lineno, msg=record.getMessage())
+
+		if record.exc_info and not record.exc_text:
+			record.exc_text = self.formatException(record.exc_info)
+		if record.exc_text:
+			entry['exc'] = record.exc_text
+
+		# request context (see context), slow request latency
+		for key in ('trace', 'method', 'latency'):
+			if getattr(record, key, None) is not None:
+				entry[key] = getattr(record, key)
+
+		return json.dumps(entry)
+
+
+def context(record):
+	""" Add the trace and method of the request being served to record """
+	current = gevent.getcurrent()
+
+	if getattr(record, 'trace', None) is None and getattr(current, 'trace', None):
+		record.trace = current.trace[0]
+
+	if getattr(record, 'method', None) is None and getattr(current, 'method', None):
+		record.method = current.method
+
+	return record
+
+
+class IndexedFileHandler(logging.handlers.RotatingFileHandler):
+	""" Rotating log file with a sidecar index of (offset, time) every `every` bytes
+
+	cake logs query seeks to the records of a time range instead of scanning files.
+	"""
+
+	def __init__(self, filename, maxBytes=0, backupCount=0, every=64 << 10):
+		self.every = every
+		logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=maxBytes, backupCount=backupCount)
+
+	def _open(self):
+		stream = logging.handlers.RotatingFileHandler._open(self)
+
+		# next index entry on the first record we write
+		stream.seek(0, 2)
+		self.checkpoint = stream.tell()
+		return stream
+
+	def emit(self, record):
+		try:
+			if self.shouldRollover(record):
+				self.doRollover()
+
+			if self.stream is None:
+				self.stream = self._open()
+
+			offset = self.stream.tell()
+			if offset >= self.checkpoint:
+				with open(self.baseFilename + '.idx', 'a') as index:
+					index.write('%d %.3f\n' % (offset, record.created))
+				self.checkpoint = offset + self.every
+
+			logging.FileHandler.emit(self, record)
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except Exception:
+			self.handleError(record)
+
+	def doRollover(self):
+		# indexes follow their log files (file.N.idx)
+		for i in xrange(self.backupCount - 1, 0, -1):
+			source = '%s.%d.idx' % (self.baseFilename, i)
+			if osp.exists(source):
+				os.rename(source, '%s.%d.idx' % (self.baseFilename, i + 1))
+
+		if osp.exists(self.baseFilename + '.idx'):
+			if self.backupCount > 0:
+				os.rename(self.baseFilename + '.idx', self.baseFilename + '.1.idx')
+			else:
+				os.remove(self.baseFilename + '.idx')
+
+		logging.handlers.RotatingFileHandler.doRollover(self)
+
+
 EXCEPTION_PREFIX = '   =>  '
 
 def log_exception(msg=None):
@@ -31,7 +130,132 @@ def log_status(msg):
 	logging.log(100, msg)
 
 
-def config_logger(stream=sys.stdout, level=logging.DEBUG):
+class AsyncHandler(logging.Handler):
+	""" Buffers records in memory, a real thread writes them to target in batches
+
+	Greenlets never wait for disk writes or rollovers. Once capacity records
+	are buffered new records are dropped (and counted), or with block=True the
+	logging greenlet waits for room.
+	"""
+
+	def __init__(self, target, capacity=10000, block=False, batch=256, interval=0.05):
+		logging.Handler.__init__(self)
+
+		self.target   = target
+		self.capacity = capacity
+		self.block    = block
+		self.batch    = batch    # records written per pass
+		self.interval = interval # seconds the thread sleeps once the buffer is empty
+
+		# only our thread uses target (gevent locks can't be shared with real threads)
+		self.target.lock = None
+
+		self.records  = collections.deque()
+		self.counters = dict(logged=0, dropped=0, reported=0)
+
+		self.sleep   = gevent.monkey.get_original('time', 'sleep')
+		self.closed  = False
+
+		self.start()
+		atexit.register(self.flush)
+
+	def start(self):
+		""" Start the writer thread (again in forked processes, which only inherit the buffer) """
+		self.pid = os.getpid()
+
+		# records of the parent are written by the parent, its lock may have been held
+		self.records.clear()
+		self.writing = gevent.monkey.get_original('thread', 'allocate_lock')()
+
+		# held until the thread exits (see close)
+		self.running = gevent.monkey.get_original('thread', 'allocate_lock')()
+		self.running.acquire()
+
+		gevent.monkey.get_original('thread', 'start_new_thread')(self.run, ())
+
+	def setFormatter(self, formatter):
+		logging.Handler.setFormatter(self, formatter)
+		self.target.setFormatter(formatter)
+
+	def prepare(self, record):
+		# the thread must not touch objects greenlets keep using (nor knows the request)
+		context(record)
+		record.msg = record.getMessage()
+		record.args = None
+
+		if record.exc_info:
+			record.exc_text = (self.formatter or logging._defaultFormatter).formatException(record.exc_info)
+			record.exc_info = None
+
+		return record
+
+	def emit(self, record):
+		if self.pid != os.getpid():
+			self.start()
+
+		while len(self.records) >= self.capacity:
+			if not self.block or self.closed:
+				self.counters['dropped'] += 1
+				return
+
+			gevent.sleep(self.interval)
+
+		try: self.records.append(self.prepare(record))
+		except Exception:
+			self.handleError(record)
+		else:
+			self.counters['logged'] += 1
+
+	def write(self):
+		""" Write a batch of records, False once the buffer is empty """
+		with self.writing:
+			dropped = self.counters['dropped'] - self.counters['reported']
+			if dropped:
+				self.counters['reported'] += dropped
+				self.target.emit(logging.makeLogRecord(dict(levelno=logging.WARNING, levelname='WARNING',
+					msg='[log] %d records dropped (buffer full)' % dropped, filename=__file__, lineno=0)))
+
+			for i in xrange(self.batch):
+				try: record = self.records.popleft()
+				except IndexError:
+					return False
+
+				self.target.emit(record)
+
+			return True
+
+	def run(self):
+		try:
+			while not self.closed:
+				if not self.write():
+					self.sleep(self.interval)
+		finally:
+			self.running.release()
+
+	def flush(self):
+		while self.write():
+			pass
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+
+			# the thread must not outlive the interpreter (forked processes may never have started theirs)
+			if self.pid == os.getpid():
+				self.running.acquire()
+
+			self.flush()
+			self.target.close()
+
+		logging.Handler.close(self)
+
+
+def config_logger(stream=sys.stdout, level=logging.DEBUG, max_bytes=10 << 20, backups=5, capacity=10000, block=False,
+		fmt='text', module=None):
+	""" Log to stream or a rotating file (written from a thread, see AsyncHandler)
+
+	fmt='json' writes JSON lines (module names the records), see cake logs.
+	"""
 	logger = logging.getLogger()
 	logger.setLevel(level)
 
@@ -40,14 +264,19 @@ def config_logger(stream=sys.stdout, level=logging.DEBUG):
 	if stream in [sys.stdout, sys.stderr]:
 		handler = logging.StreamHandler(stream)
 	else:
-		handler = logging.handlers.RotatingFileHandler(stream, maxBytes=409600, backupCount=3)
+		handler = IndexedFileHandler(stream, maxBytes=max_bytes, backupCount=backups)
+
+	handler = AsyncHandler(handler, capacity, block)
 	logger.addHandler(handler)
 
 	# formatter
-	formatter = MyFormatter(
-		fmt = '%(asctime)s %(levelname)-8s %(fname)-20s  %(message)s',
-		datefmt = '%b %d %Y %H:%M:%S',
-	)
+	if fmt == 'json':
+		formatter = JsonFormatter(module)
+	else:
+		formatter = MyFormatter(
+			fmt = '%(asctime)s %(levelname)-8s %(fname)-20s  %(message)s',
+			datefmt = '%b %d %Y %H:%M:%S',
+		)
 	handler.setFormatter(formatter)
 	
 	# custom levels
@@ -57,6 +286,8 @@ def config_logger(stream=sys.stdout, level=logging.DEBUG):
 	logging.addLevelName(100, 'STATUS')
 	logging.status = log_status
 
+	return handler
+
 
 # test
 if __name__ == '__main__':
@@ -15,7 +15,7 @@ from gevent_zeromq import zmq
 
 # pyscale
 from .log import config_logger
-from ..zmq import Socket, MultiSocket, RpcServer
+from ..zmq import Socket, MultiSocket, RpcServer, SocketPool, Publisher, Subscriber, registry
 
 # project
 from config.app import Configuration
@@ -25,10 +25,56 @@ def job(method):
 	method.job = True
 	return method
 
+def subscribe(module, topic='', hwm=1000, batch=None):
+	""" Consume the messages module publishes on topic (see zmq.Subscriber) """
+	def decorator(method):
+		method.subscribe = dict(name=module, topic=topic, hwm=hwm, batch=batch)
+		return method
+
+	return decorator
+
 
 class BaseModule(object):
 	""" Basic Module Class (daemon) """
 
+	# worker processes for @api(cpu=True) methods (default: one per core), forked
+	# when the module runs: they work on a copy of the module state at that time
+	processes = None
+
+	# tcp endpoint for other hosts (e.g. tcp://*:5555, or tcp://* for a random port)
+	tcp = None
+
+	# rpc worker autoscaling (a ScalingPolicy, default: 1 to 64 workers)
+	scaling = None
+
+	# admission control: requests queued beyond max_pending are rejected with
+	# an OverloadError, hwm bounds the zmq queues of the rpc frontend
+	max_pending = 1024
+	hwm = None
+
+	# requests carry a priority (higher first, default 0); {priority: weight}
+	# switches from strict priority to weighted fair queuing
+	priorities = None
+
+	# published messages queued beyond pub_hwm are dropped
+	pub_hwm = 1000
+
+	# binary results of at least shm_threshold bytes (e.g. 1 << 20) reach callers
+	# on the same host through shared memory, as read-only buffers instead of str
+	shm_threshold = None
+
+	# replies of at least compress_threshold bytes are compressed for callers on
+	# other hosts (see self.rpc.compression to check it pays off, None disables)
+	compress_threshold = 64 << 10
+
+	# fraction of untraced requests that start a trace (see cake trace)
+	trace_sample = 0.0
+
+	# requests taking slow_threshold seconds or more are logged as warnings
+	# (a slow_sample fraction of them, None disables)
+	slow_threshold = None
+	slow_sample = 1.0
+
 	def __init__(self, context=None):
 		# app config
 		self.conf = Configuration()
@@ -36,7 +82,10 @@ class BaseModule(object):
 		# module config
 		self.name = osp.basename(osp.dirname(osp.abspath(sys.argv[0])))
 		self.pidfile = "tmp/pids/%s.pid" % self.name
-		config_logger("logs/%s.log" % self.name, self.conf.log_level)
+		self.log_handler = config_logger("logs/%s.log" % self.name, self.conf.log_level,
+				max_bytes=getattr(self.conf, 'log_max_bytes', 10 << 20), backups=getattr(self.conf, 'log_backups', 5),
+				capacity=getattr(self.conf, 'log_buffer', 10000), block=getattr(self.conf, 'log_block', False),
+				fmt=getattr(self.conf, 'log_format', 'text'), module=self.name)
 
 		# zmq context
 		self.context = context or zmq.Context.instance()
@@ -44,18 +93,43 @@ class BaseModule(object):
 		# pool of greenlets
 		self.jobs = gevent.pool.Group()
 
+		# multi-host discovery
+		registry.path = getattr(self.conf, 'registry', registry.path)
+
 		# zmq REQ/REP API
-		self.rpc = RpcServer(self, "ipc://tmp/sockets/rpc/%s.sock" % self.name)
+		self.rpc = RpcServer(self, "ipc://tmp/sockets/rpc/%s.sock" % self.name, tcp=self.tcp, policy=self.scaling,
+				max_pending=self.max_pending, hwm=self.hwm, weights=self.priorities, shm_threshold=self.shm_threshold,
+				compress_threshold=self.compress_threshold, trace_sample=self.trace_sample,
+				slow_threshold=self.slow_threshold, slow_sample=self.slow_sample)
 		self.rpc.run()
 
-		# spawn jobs
+		# zmq PUB socket (events, invalidations of @cached methods for client caches)
+		if not osp.isdir('tmp/sockets/pub'):
+			os.makedirs('tmp/sockets/pub')
+
+		self.publisher = Publisher("ipc://tmp/sockets/pub/%s.sock" % self.name, self.context, self.pub_hwm)
+		self.subscribers = []
+
+		# spawn jobs and subscribers, advertise cached methods
+		self.cacheable = {}
+
 		bases = self.__class__.__mro__
 		for base in bases:
-			for func in base.__dict__.values():
+			for name, func in base.__dict__.items():
 				if getattr(func, 'job', None):
 					method = func.__get__(self, self.__class__)
 					self.jobs.spawn(method)
 
+				if getattr(func, 'subscribe', None):
+					subscriber = Subscriber(handler=func.__get__(self, self.__class__), context=self.context, **func.subscribe)
+					self.subscribers.append(subscriber)
+					self.jobs.spawn(subscriber.read)
+					self.jobs.spawn(subscriber.consume)
+
+				if getattr(func, 'cache', None) is not None and name not in self.cacheable:
+					self.cacheable[name] = func.cache.ttl
+					func.cache.listeners.append(lambda key, name=name: self.publisher.sock.send_multipart(['__invalidate', name, key or '']))
+
 
 	def run(self):
 		""" Run the current module (start greenlets) """
@@ -70,6 +144,9 @@ class BaseModule(object):
 				logging.warn("%s seems to have crashed.. deleting pidfile" % self.name)
 				os.remove(self.pidfile)
 
+		# cpu method replicas get the fully constructed module
+		self.rpc.fork()
+
 		# run all jobs
 		with self:
 			try:
@@ -78,19 +155,23 @@ class BaseModule(object):
 				self.jobs.kill()
 				# zmq.Context.instance().term()
 
-	def sock(self, name, _type=None):
-		""" Socket convenience function """
+	def publish(self, topic, msg):
+		""" Publish msg to the subscribers of topic (False if dropped, see pub_hwm) """
+		return self.publisher.publish(topic, msg)
+
+	def sock(self, name, _type=None, **kwargs):
+		""" Socket convenience function (async=True returns AsyncResults) """
 		if _type:
-			return Socket(name, _type)
+			return Socket(name, _type, **kwargs)
 		else:
-			return Socket(name)
+			return Socket(name, **kwargs)
 
-	def multisock(self, name, _type=None):
-		""" MultiSocket convenince function """
+	def multisock(self, name, _type=None, **kwargs):
+		""" MultiSocket convenince function (calls run in parallel, see timeout/quorum) """
 		if _type:
-			return MultiSocket(name, _type)
+			return MultiSocket(name, _type, **kwargs)
 		else:
-			return MultiSocket(name)
+			return MultiSocket(name, **kwargs)
 
 	def __enter__(self):
 		logging.status("%s started" % self.name)
@@ -106,6 +187,17 @@ class BaseModule(object):
 		# remove pidfile
 		os.remove(self.pidfile)
 
+		# stop worker processes
+		self.rpc.close()
+
+		# stop pub/sub
+		self.publisher.close()
+		for subscriber in self.subscribers:
+			subscriber.close()
+
+		# close pooled client connections
+		SocketPool.instance(self.context).close()
+
 		return False
 
 	def help(self):
@@ -1,78 +1,156 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import sys
+import json
+import time
 
 from cake.lib import puts
-from cake.color import fore, style
+from cake.color import fore, style, ANSI_PATTERN
 
 from ..lib.log import EXCEPTION_PREFIX
 
-def println(line):
+
+colors = dict(STATUS=fore.white, DEBUG=fore.white, INFO=fore.green, WARNING=fore.yellow, ERROR=fore.red, EXCEPT=fore.red)
+
+# patterns are compiled once, lines are colored in a single pass
+BLANK   = re.compile(r'\s*$')
+HEADER  = re.compile(r'==> (.*) <==$')
+ANSI    = re.compile(ANSI_PATTERN)
+
+# date (3 words), time, level, [file:line], message
+LINE    = re.compile(r'(\S*\s+\S*\s+\S*\s+)(\S*\s+)(\S*\s+)(\S*\s+)(.*)$')
+
+TOKEN   = re.compile(r'STATUS|DEBUG|INFO|WARNING|ERROR|EXCEPT|~>|<~|[\[\]()\'"]')
+TOKENS  = dict((name, color(name)) for name, color in colors.items())
+TOKENS.update((char, fore.cyan(char)) for char in '[]()\'"')
+TOKENS.update({'~>': fore.blue('~>'), '<~': fore.yellow('<~')})
+
+def paint(match):
+	return TOKENS[match.group(0)]
+
+
+def format_entry(entry):
+	""" JSON log record (see lib.log.JsonFormatter) """
+	stamp = time.strftime('%b %d %Y %H:%M:%S', time.localtime(entry['time']))
+	level = colors.get(entry['level'], fore.white)('%-8s' % entry['level'])
+	context = ' '.join('%s=%s' % (key, entry[key]) for key in ('trace', 'method', 'latency') if key in entry)
+
+	line = '%s %s %s %s  %s  %s' % (fore.cyan(stamp), fore.blue(entry['module']), level,
+		fore.cyan('[%s:%s]' % (entry['file'], entry['line'])), entry['msg'], fore.black(context))
+
+	if 'exc' in entry:
+		line += ''.join('\n' + fore.red(EXCEPTION_PREFIX + exc) for exc in entry['exc'].split('\n'))
+
+	return line
+
+def print_entry(entry):
+	puts(format_entry(entry))
+
+def colorize(line):
+	""" Colored log line (without newline) """
 	# blank line
-	if re.match(r'\s*$', line):
-		return puts(line)
+	if BLANK.match(line):
+		return line
+
+	# json record
+	if line.startswith('{'):
+		try: return format_entry(json.loads(line))
+		except (ValueError, KeyError):
+			pass
 
 	# logfile header
-	mobj = re.match(r'==> (.*) <==$', line)
+	mobj = HEADER.match(line)
 	if mobj:
-		return puts(style.bright(fore.black('==> ') + fore.white(mobj.group(1)) + fore.black(' <==')))
-	
+		return style.bright(fore.black('==> ') + fore.white(mobj.group(1)) + fore.black(' <=='))
+
 	# exception line
-	if re.match(EXCEPTION_PREFIX, line):
-		return puts(fore.red(line))
+	if line.startswith(EXCEPTION_PREFIX):
+		return fore.red(line)
 
 	# standard log line
-	basic = r'(.*?\s+)'
-
-	date = basic*3
-	time = basic
-	type = basic
-	file = '(\[.*?\s+)\])'
-
-	mobj = re.match(basic*6 + r'(.*)', line)
+	mobj = LINE.match(line)
 	if not mobj:
 		# non-conventional line
-		return puts(line)
-	else:
-		groups = list(mobj.groups())
+		return line
 
-		groups.insert(0, str(fore.cyan))
-		groups.insert(4, str(fore.blue))
-		groups.insert(6, str(style.bright))
-		groups.insert(8, str(style.reset_all))
-		groups.insert(9, str(fore.cyan))
-		groups.insert(11, str(style.reset_all))
+	date, clock, level, fname, message = mobj.groups()
 
-		for idx, string in enumerate(groups):
-			string = re.sub(r'(STATUS)', fore.white(r'\1'), string)
-			string = re.sub(r'(DEBUG)', fore.white(r'\1'), string)
-			string = re.sub(r'(INFO)', fore.green(r'\1'), string)
-			string = re.sub(r'(WARNING)', fore.yellow(r'\1'), string)
-			string = re.sub(r'(ERROR)', fore.red(r'\1'), string)
-			string = re.sub(r'(EXCEPT)', fore.red(r'\1'), string)
+	return ''.join((str(fore.cyan), date, str(fore.blue), clock, str(style.bright), TOKEN.sub(paint, level),
+		str(style.reset_all), str(fore.cyan), fname, str(style.reset_all), TOKEN.sub(paint, message)))
 
-			groups[idx] = string
+def println(line):
+	puts(colorize(line))
 
 
-		groups[-1] = re.sub(r'\[', fore.cyan(r'['), groups[-1])
-		groups[-1] = re.sub(r'\]', fore.cyan(r']'), groups[-1])
+def write(output, lines):
+	""" Color lines and write them at once (without colors unless output is a tty) """
+	block = ''.join(colorize(line) + '\n' for line in lines)
+	if not output.isatty():
+		block = ANSI.sub('', block)
 
-		groups[-1] = re.sub(r'~>', fore.blue(r'~>'), groups[-1])
-		groups[-1] = re.sub(r'<~', fore.yellow(r'<~'), groups[-1])
+	output.write(block)
+	output.flush()
 
-		groups[-1] = re.sub(r'\(', fore.cyan(r'('), groups[-1])
-		groups[-1] = re.sub(r'\)', fore.cyan(r')'), groups[-1])
+def colorize_stream(source, output, size=64 << 10):
+	""" Color lines read from fd source in blocks, each block written at once """
+	rest = ''
 
-		groups[-1] = re.sub(r"'", fore.cyan(r"'"), groups[-1])
-		groups[-1] = re.sub(r'"', fore.cyan(r'"'), groups[-1])
+	while True:
+		block = os.read(source, size)
+		if not block:
+			break
 
-		return puts(''.join(groups))
+		lines = (rest + block).split('\n')
+		rest = lines.pop()
+		write(output, lines)
+
+	if rest:
+		write(output, [rest])
 
 
 def main():
-	try:
-		while True:
-			println(raw_input())
+	try: colorize_stream(sys.stdin.fileno(), sys.stdout)
 	except KeyboardInterrupt:
 		pass
+
+
+def benchmark(megabytes=8):
+	""" Lines per second colored over a synthetic log: python -m pyscale.tools.logger [megabytes] """
+	import random
+	import tempfile
+
+	samples = [
+		'Oct 18 2026 11:38:09 DEBUG    [rpc.py:135]          [zmq] <~ self.get(\'key %d\')',
+		'Oct 18 2026 11:38:09 INFO     [module.py:210]       [zmq] ~> kv.set(\'key %d\', {\'a\': 1})',
+		'Oct 18 2026 11:38:09 WARNING  [rpc.py:120]          [zmq] slow request (%d.2 ms): kv.rows(100)',
+		'Oct 18 2026 11:38:09 ERROR    [rpc.py:233]          [zmq] Request error: "ValueError(%d)"',
+		EXCEPTION_PREFIX + '  File "app/kv/main", line %d, in boom',
+		'{"levelno": 20, "file": "rpc.py", "level": "INFO", "msg": "[zmq] <~ self.get(%d)", "line": 135, '
+			'"time": 1792323489.33, "method": "get", "module": "kv"}',
+	]
+
+	with tempfile.TemporaryFile() as source:
+		size = 0
+		while size < megabytes << 20:
+			line = random.choice(samples) % random.randint(0, 1 << 16) + '\n'
+			source.write(line)
+			size += len(line)
+
+		source.seek(0)
+		count = sum(1 for line in source)
+
+		with open(os.devnull, 'w') as output:
+			source.seek(0)
+			start = time.time()
+			colorize_stream(source.fileno(), output)
+			elapsed = time.time() - start
+
+	print '%d lines (%.1f MB) in %.2f s: %d lines/s, %.1f MB/s' % (count, size / float(1 << 20), elapsed,
+		count / elapsed, size / float(1 << 20) / elapsed)
+
+
+if __name__ == '__main__':
+	benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,354 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import heapq
+import select
+import itertools
+import ctypes
+import ctypes.util
+import os.path as osp
+
+from ..lib import PyscaleError
+from .logger import write
+
+
+levels = dict(DEBUG=10, INFO=20, WARNING=30, ERROR=40, CRITICAL=50, EXCEPT=75, STATUS=100)
+
+
+def parse_time(value):
+	""" Epoch seconds, a relative time ago (30s, 10m, 2h, 1d) or [YYYY-MM-DD] HH:MM[:SS] """
+	if value is None:
+		return None
+
+	value = str(value).strip()
+	mobj = re.match(r'(\d+(?:\.\d+)?)([smhd])$', value)
+	if mobj:
+		return time.time() - float(mobj.group(1)) * dict(s=1, m=60, h=3600, d=86400)[mobj.group(2)]
+
+	if re.match(r'\d+(\.\d+)?$', value):
+		return float(value)
+
+	today = time.strftime('%Y-%m-%d')
+	for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+		for text in (value, '%s %s' % (today, value)):
+			try: return time.mktime(time.strptime(text, fmt))
+			except ValueError:
+				continue
+
+	raise PyscaleError('Invalid time: %s' % value)
+
+def log_files(module='*'):
+	""" Log files of module, oldest first (rotated files have higher numbers) """
+	files = []
+	for path in glob.glob('logs/%s.log' % module):
+		rotated = glob.glob(path + '.[0-9]*')
+		rotated = [name for name in rotated if re.search(r'\.\d+$', name)]
+
+		files.extend(sorted(rotated, key=lambda name: -int(name.rsplit('.', 1)[1])))
+		files.append(path)
+
+	return files
+
+def read_index(path):
+	entries = []
+	try:
+		with open(path + '.idx') as index:
+			for line in index:
+				offset, created = line.split()
+				entries.append((int(offset), float(created)))
+	except (IOError, ValueError):
+		pass
+
+	return entries
+
+def query(module='*', level=None, since=None, until=None, trace=None, grep=None):
+	""" Records of JSON log files matching the filters (times as for parse_time) """
+	since, until = parse_time(since), parse_time(until)
+	levelno = levels.get(str(level).upper(), 0) if level else 0
+
+	for path in log_files(module):
+		index = read_index(path)
+
+		# the last checkpoint before since (records are written in time order)
+		offset = 0
+		for entry_offset, created in index:
+			if until is not None and created > until:
+				break
+			if since is not None and created <= since:
+				offset = entry_offset
+
+		if index and until is not None and index[0][1] > until:
+			continue
+
+		with open(path) as f:
+			f.seek(offset)
+
+			for line in f:
+				if not line.startswith('{'):
+					continue
+
+				try: entry = json.loads(line)
+				except ValueError:
+					continue
+
+				if until is not None and entry['time'] > until:
+					break
+				if since is not None and entry['time'] < since:
+					continue
+				if entry.get('levelno', 0) < levelno:
+					continue
+				if trace is not None and entry.get('trace') != trace:
+					continue
+				if grep is not None and grep not in entry['msg']:
+					continue
+
+				yield entry
+
+
+# == Follow ==
+STAMP = re.compile(r'(\w{3} \d\d \d{4} \d\d:\d\d:\d\d) +(\w+)')
+
+IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x40, 0x80, 0x100, 0x200
+
+def inotify(path):
+	""" Fd readable on changes in directory path (None without inotify, e.g. not on linux) """
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		fd = libc.inotify_init()
+	except (OSError, AttributeError):
+		return None
+
+	if fd < 0:
+		return None
+
+	if libc.inotify_add_watch(fd, path, IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+		os.close(fd)
+		return None
+
+	return fd
+
+
+class LogFile(object):
+	""" Followed log file, reopened once rotated """
+
+	def __init__(self, path, lines=None):
+		self.path    = path
+		self.fd      = None
+		self.inode   = None
+		self.offset  = 0
+		self.rest    = ''   # partial line
+		self.last    = 0    # time of the last record read
+		self.record  = None # last record read (continuation lines are added to it)
+
+		self.open(lines=lines)
+
+	def open(self, path=None, lines=None):
+		""" Open path (or a backup) from the start, or from its last lines """
+		self.fd = os.open(path or self.path, os.O_RDONLY)
+		self.inode = os.fstat(self.fd).st_ino
+		self.offset = 0
+		self.rest = ''
+
+		if lines is not None:
+			self.offset = self.tail(lines)
+			os.lseek(self.fd, self.offset, os.SEEK_SET)
+
+	def tail(self, lines, size=8 << 10):
+		""" Offset of the last lines """
+		end = offset = os.fstat(self.fd).st_size
+		count = 0
+
+		while offset > 0:
+			offset = max(0, offset - size)
+			os.lseek(self.fd, offset, os.SEEK_SET)
+			block = os.read(self.fd, min(size, end - offset))
+
+			# a trailing newline ends the last line
+			count += block.count('\n') - (offset + len(block) == end and block.endswith('\n'))
+			if count >= lines:
+				for i in xrange(count - lines + 1):
+					index = block.index('\n')
+					block, offset = block[index + 1:], offset + index + 1
+				return offset
+
+		return 0
+
+	def read(self):
+		""" New complete lines """
+		data = []
+		while True:
+			block = os.read(self.fd, 64 << 10)
+			if not block:
+				break
+			data.append(block)
+
+		self.offset += sum(len(block) for block in data)
+
+		lines = (self.rest + ''.join(data)).split('\n')
+		self.rest = lines.pop()
+		return lines
+
+	def rotated(self):
+		""" Whether path was rotated (or truncated) since we opened it """
+		try: stat = os.stat(self.path)
+		except OSError:
+			# between the rename and the new file
+			return False
+
+		return stat.st_ino != self.inode or stat.st_size < self.offset
+
+	def backups(self):
+		""" Backups rotated after the file we have open, oldest first """
+		newer = []
+		for i in itertools.count(1):
+			path = '%s.%d' % (self.path, i)
+			try: stat = os.stat(path)
+			except OSError:
+				break
+
+			if stat.st_ino == self.inode:
+				return newer[::-1]
+			newer.append(path)
+
+		# truncated or removed
+		return []
+
+	def close(self):
+		os.close(self.fd)
+		self.fd = None
+
+
+class Follower(object):
+	""" Follows module logs, records of all files merged in time order
+
+	Records are held until every file is past them, or for delay seconds
+	(text logs have one second resolution). Records below level are dropped
+	before they're formatted.
+	"""
+
+	def __init__(self, module='*', level=None, lines=10, delay=1.0, interval=0.25):
+		self.patterns = ['logs/%s.log' % name for name in module.split(',')]
+		self.levelno  = levels.get(str(level).upper(), 0) if level else 0
+		self.lines    = lines
+		self.delay    = delay
+		self.interval = interval
+
+		self.files  = {}
+		self.heap   = []
+		self.seq    = itertools.count()
+		self.shown  = None
+		self.stamps = {}
+
+	def parse(self, line):
+		""" (time, levelno) of the record line starts, None for continuation lines """
+		if line.startswith('{'):
+			try:
+				entry = json.loads(line)
+				return entry['time'], entry.get('levelno', 0)
+			except (ValueError, KeyError, TypeError):
+				return None
+
+		mobj = STAMP.match(line)
+		if not mobj:
+			return None
+
+		stamp = mobj.group(1)
+		if stamp not in self.stamps:
+			if len(self.stamps) > 1000:
+				self.stamps.clear()
+			self.stamps[stamp] = time.mktime(time.strptime(stamp, '%b %d %Y %H:%M:%S'))
+
+		return self.stamps[stamp], levels.get(mobj.group(2), 0)
+
+	def read(self, log):
+		for line in log.read():
+			parsed = self.parse(line)
+
+			if parsed is None and log.record is not None and not log.record[-1]:
+				log.record[4].append(line)
+				continue
+
+			if parsed is None:
+				parsed = (log.last, log.record[3] if log.record else 0)
+
+			log.last = max(log.last, parsed[0])
+			log.record = [parsed[0], next(self.seq), log.path, parsed[1], [line], False]
+			heapq.heappush(self.heap, log.record)
+
+	def scan(self):
+		""" Pick up new log files, read new lines, follow rotated files """
+		for pattern in self.patterns:
+			for path in glob.glob(pattern):
+				if path not in self.files:
+					try: self.files[path] = LogFile(path, self.lines)
+					except OSError:
+						continue
+
+		# files showing up later are read from the start
+		self.lines = None
+
+		for log in self.files.values():
+			if log.fd is not None:
+				self.read(log)
+
+			if log.fd is None or log.rotated():
+				self.reopen(log)
+
+	def reopen(self, log):
+		""" Read the end of a rotated file and the backups rotated after it, then follow the new file """
+		paths = [log.path]
+
+		if log.fd is not None:
+			# the handler closed the renamed file, nothing is written to it anymore
+			self.read(log)
+			paths[:0] = log.backups()
+			log.close()
+
+		for path in paths:
+			try: log.open(path)
+			except OSError:
+				continue
+
+			self.read(log)
+			if path != log.path:
+				log.close()
+
+	def flush(self, output):
+		""" Write the records all files are past """
+		now = time.time() - self.delay
+		mark = min([max(log.last, now) for log in self.files.values()] or [now])
+
+		lines = []
+		while self.heap and self.heap[0][0] <= mark:
+			record = heapq.heappop(self.heap)
+			record[-1] = True
+
+			if record[3] < self.levelno:
+				continue
+
+			if record[2] != self.shown and len(self.files) > 1:
+				self.shown = record[2]
+				lines.append('==> %s <==' % record[2])
+
+			lines.extend(record[4])
+
+		if lines:
+			write(output, lines)
+
+	def follow(self, output=sys.stdout):
+		notify = inotify(osp.dirname(self.patterns[0]))
+
+		while True:
+			self.scan()
+			self.flush(output)
+
+			if notify is None:
+				time.sleep(self.interval)
+			elif select.select([notify], [], [], self.interval)[0]:
+				os.read(notify, 64 << 10)
@@ -3,11 +3,11 @@
 
 import sys
 import re
+import time
 import glob
 import operator
 import os
 import os.path as osp
-import subprocess as sbp
 import nose
 import fnmatch
 
@@ -16,6 +16,8 @@ from cake.color import fore
 from cake.errors import CakeError
 
 from ..zmq import Socket
+from .logs import query, Follower
+from .logger import print_entry
 from ..utils import command, execute
 from ..lib import PyscaleError
 
@@ -68,6 +70,8 @@ def stop(module='*'):
 		shell('kill %s' % pid)
 		shell('rm -f %s' % pidfile)
 		shell('rm -f tmp/sockets/*/%s.sock' % module)
+		shell('rm -f tmp/registry/%s/%s-*' % (module, os.uname()[1]))
+		shell('rm -f tmp/shm/%s-%s-*' % (module, pid))
 
 		puts(fore.cyan("%-10s" % module) + "(pid: %s) stopped" % fore.red(pid))
 
@@ -81,9 +85,11 @@ def restart(module='*', env='development'):
 @task
 def clean(module='*'):
 	""" Clean temp files """
-	shell('rm -f logs/%s.log' % module)
+	shell('rm -f logs/%s.log logs/%s.log.idx' % (module, module))
 	shell('rm -f tmp/pids/%s.pid' % module)
 	shell('rm -f tmp/sockets/*/%s.sock' % module)
+	shell('rm -f tmp/registry/%s/%s-*' % (module, os.uname()[1]))
+	shell('rm -f tmp/shm/%s-*' % module)
 
 @task
 def reset(module='*', env='development'):
@@ -137,16 +143,97 @@ def status():
 				puts(re.sub('app/(.*?)/main', color, ps))
 
 @task
-def log(module='*', lines=10):
-	""" View log for [module] """
+def stats(module='*', timeout=2):
+	""" View rpc metrics of running [module] """
+	ms = lambda value: '%8.2f' % (value * 1000) if value is not None else '%8s' % '-'
+
+	for module, pid, pidfile in running_modules(module):
+		reply = Socket(module, timeout=float(timeout))._request([('__stats', [], {})])
+		if 'result' not in reply:
+			puts(fore.cyan("%-10s" % module) + fore.red(reply.get('error', 'no stats')))
+			continue
+
+		stats, broker, wait = reply['result'], reply['result']['broker'], reply['result']['wait']
+		puts(fore.cyan("%-10s" % module) + "up %ds, %d workers (%d busy), %d queued, %d shed, %d expired" % (
+			stats['uptime'], broker['workers'], broker['busy'], broker['queued'], broker['shed'], broker['expired']))
+		puts("  wait (ms): p50 %s  p99 %s  max %s" % (ms(wait.get('p50')), ms(wait.get('p99')), ms(wait.get('max'))))
+
+		puts(fore.green("  %-24s %8s %6s %8s %8s %8s %8s %10s" % (
+			'method', 'calls', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'ser ms', 'avg bytes')))
+		for method, entry in sorted(stats['methods'].items(), key=lambda item: -item[1]['calls']):
+			execute, size = entry['execute'], entry['size']
+			puts("  %-24s %8d %6d %s %s %s %s %10d" % (method, entry['calls'], entry['errors'], ms(execute.get('p50')),
+				ms(execute.get('p90')), ms(execute.get('p99')), ms(entry['serialize'].get('mean')), size.get('mean', 0)))
+
+@task
+def trace(trace_id=None, timeout=2):
+	""" View the call tree of trace <id> (recent traces without id) """
+	spans = []
+	for module, pid, pidfile in running_modules():
+		reply = Socket(module, timeout=float(timeout))._request([('__trace', [trace_id] if trace_id else [], {})])
+		spans.extend(reply.get('result', []))
+
+	if not spans:
+		raise CakeError('No spans found (start traces with pyscale.zmq.trace or trace_sample)')
+
+	if trace_id is None:
+		# the slowest root span of each trace
+		roots = {}
+		for span in spans:
+			if span['duration'] >= roots.get(span['trace'], span)['duration']:
+				roots[span['trace']] = span
+
+		for span in sorted(roots.values(), key=lambda span: -span['start']):
+			puts("%s %s %8.2f ms  %s" % (fore.cyan(span['trace']), time.strftime('%H:%M:%S', time.localtime(span['start'])),
+				span['duration'] * 1000, '%s.%s' % (span['module'], span['method'])))
+		return
+
+	# spans whose caller wasn't traced start the tree
+	ids = set(span['span'] for span in spans)
+	children = {}
+	for span in sorted(spans, key=lambda span: span['start']):
+		children.setdefault(span['parent'] if span['parent'] in ids else None, []).append(span)
+
+	origin = min(span['start'] for span in spans)
+	def show(span, depth):
+		name = '%s.%s' % (fore.cyan(span['module']), span['method'])
+		error = fore.red(' (error)') if span['error'] else ''
+		puts("%s%s %8.2f ms  (+%.2f ms)%s" % ('  ' * depth, name, span['duration'] * 1000,
+			(span['start'] - origin) * 1000, error))
+
+		for child in children.get(span['span'], []):
+			show(child, depth + 1)
+
+	for root in children.get(None, []):
+		show(root, 0)
+
+@task
+def log(module='*', lines=10, level=None):
+	""" View log for [module] (kv,kv2 for several), level=WARNING hides lower levels """
 
 	if not glob.glob('logs/*.log'):
 		raise CakeError('No logfiles found')
 	else:
-		try: sbp.call("tail -n %s -f logs/%s.log | PYTHONPATH=. %s tools/logger" % (lines, module, python()), shell=True)
+		try: Follower(module, level, int(lines)).follow()
 		except KeyboardInterrupt: pass
 
 
+@task
+def logs(command='query', module='*', level=None, since=None, until=None, trace=None, grep=None, limit=1000):
+	""" Query JSON logs: cake logs query [module] level=WARNING since=1h until=12:30 trace=<id> grep=<text> """
+	if command != 'query':
+		raise CakeError('Unknown logs command: %s' % command)
+
+	count = 0
+	for entry in query(module, level, since, until, trace, grep):
+		print_entry(entry)
+
+		count += 1
+		if count >= int(limit):
+			puts(fore.magenta('... (limit reached)'))
+			break
+
+
 # == Debugging ==
 @task
 def run(what, *args):
@@ -1,3 +1,8 @@
 from rpc import RpcServer
 from socket import Socket
 from multisocket import MultiSocket
+from pool import SocketPool
+from discovery import Registry, registry
+from scaling import ScalingPolicy
+from pubsub import Publisher, Subscriber
+from tracing import trace
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import gevent
+from gevent_zeromq import zmq
+
+from ..lib.decorators import Cache
+
+
+class ReadThrough(object):
+	""" Client cache of the @cached methods of a module, evicted by its invalidations """
+
+	def __init__(self, name, methods, context, maxsize=1024):
+		self.name   = name
+		self.caches = dict((method, Cache(ttl, maxsize)) for method, ttl in methods.items())
+
+		# replies requested before an invalidation may be stale
+		self.generation = 0
+
+		self.sock = context.socket(zmq.SUB)
+		self.sock.connect("ipc://tmp/sockets/pub/%s.sock" % name)
+		self.sock.setsockopt(zmq.SUBSCRIBE, '__invalidate')
+
+		self.reader = gevent.spawn(self.read)
+
+	def get(self, method, key):
+		return self.caches[method].get(key)
+
+	def put(self, method, key, generation, value):
+		if generation == self.generation:
+			self.caches[method].put(key, value)
+
+	def read(self):
+		while True:
+			# invalidation: [__invalidate][method][key or empty for all]
+			topic, method, key = self.sock.recv_multipart()
+			logging.debug("[zmq] %s: invalidate %s %s", self.name, method, key)
+
+			self.generation += 1
+			if method in self.caches:
+				self.caches[method].drop(key or None)
+
+	def close(self):
+		self.reader.kill()
+		self.sock.close()
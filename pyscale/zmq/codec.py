@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+from cStringIO import StringIO
+
+# let zmq select jsonapi (for performance)
+from zmq.utils import jsonapi
+if jsonapi.jsonmod is None:
+	raise ImportError('jsonlib{1,2}, json or simplejson library is required.')
+
+# optional serializers
+try: import msgpack
+except ImportError: msgpack = None
+else:
+	if getattr(msgpack, 'version', (0,)) < (0, 5, 2):
+		msgpack = None
+
+
+class Codec(object):
+	""" Wire serializer (the name travels in the header frame) """
+	name = None
+
+	def dumps(self, obj):
+		raise NotImplementedError
+
+	def loads(self, data):
+		raise NotImplementedError
+
+
+class JsonCodec(Codec):
+	""" Fallback codec (tuples become lists, str must be utf-8) """
+	name = 'json'
+
+	def dumps(self, obj):
+		return jsonapi.dumps(obj)
+
+	def loads(self, data):
+		return jsonapi.loads(data)
+
+
+class PickleCodec(Codec):
+	""" Pickle protocol 2 restricted to plain data (no globals, no instances) """
+	name = 'pickle'
+
+	# pickled without globals (loads refuses everything else)
+	PLAIN = frozenset([type(None), bool, int, long, float, str, unicode, tuple, list, dict])
+
+	def _plain(self, obj):
+		# called for every object, subclasses and classes alike are refused
+		if type(obj) not in self.PLAIN:
+			raise TypeError('%s is not plain data' % type(obj).__name__)
+
+	def _normalize(self, obj):
+		""" Copy of obj with subclasses of plain types (OrderedDict, namedtuple, ...) as their base type """
+		if type(obj) in self.PLAIN and not isinstance(obj, (dict, list, tuple)):
+			return obj
+		elif isinstance(obj, dict):
+			return dict((self._normalize(key), self._normalize(value)) for key, value in obj.iteritems())
+		elif isinstance(obj, list):
+			return [self._normalize(item) for item in obj]
+		elif isinstance(obj, tuple):
+			return tuple(self._normalize(item) for item in obj)
+		elif isinstance(obj, (str, bytearray)):
+			return str(obj)
+		elif isinstance(obj, unicode):
+			return unicode(obj)
+
+		# refused by _plain
+		return obj
+
+	def _dumps(self, obj):
+		buf = StringIO()
+		pickler = pickle.Pickler(buf, 2)
+		pickler.persistent_id = self._plain
+		pickler.dump(obj)
+		return buf.getvalue()
+
+	def dumps(self, obj):
+		# plain data pickles directly, other containers are copied once
+		try: return self._dumps(obj)
+		except TypeError:
+			return self._dumps(self._normalize(obj))
+
+	def loads(self, data):
+		unpickler = pickle.Unpickler(StringIO(data))
+		unpickler.find_global = None
+		return unpickler.load()
+
+
+class MsgpackCodec(Codec):
+	""" Fastest codec (bytes and unicode stay distinct, tuples use an ext type) """
+	name = 'msgpack'
+
+	TUPLE = 1
+
+	# msgpack >= 1.0 refuses non-string map keys by default (dumps takes them)
+	LOADS = dict(strict_map_key=False) if msgpack is not None and msgpack.version >= (1, 0) else {}
+
+	def _default(self, obj):
+		if isinstance(obj, tuple):
+			return msgpack.ExtType(self.TUPLE, self.dumps(list(obj)))
+		elif isinstance(obj, dict):
+			return dict(obj)
+		elif isinstance(obj, list):
+			return list(obj)
+
+		raise TypeError('%s is not plain data' % type(obj).__name__)
+
+	def _ext_hook(self, code, data):
+		if code == self.TUPLE:
+			return tuple(self.loads(data))
+
+		return msgpack.ExtType(code, data)
+
+	def dumps(self, obj):
+		return msgpack.packb(obj, use_bin_type=True, strict_types=True, default=self._default)
+
+	def loads(self, data):
+		return msgpack.unpackb(data, raw=False, ext_hook=self._ext_hook, **self.LOADS)
+
+
+# available codecs in order of preference
+codecs = [MsgpackCodec(), PickleCodec(), JsonCodec()]
+if msgpack is None:
+	codecs.pop(0)
+
+registry = dict((codec.name, codec) for codec in codecs)
+default = registry['json']
+
+
+def get_codec(name):
+	""" Lookup codec by name (as received in a header frame) """
+	try: return registry[name]
+	except KeyError:
+		raise ValueError('Unknown codec: %s' % name)
+
+def choose_codec(advertised):
+	""" Pick the fastest codec advertised by the other side """
+	for codec in codecs:
+		if codec.name in advertised:
+			return codec
+
+	return default
@@ -3,6 +3,9 @@
 
 import re
 import logging
+import repr as reprlib
+
+import gevent
 
 
 patterns = {}
@@ -10,9 +13,15 @@ patterns['REQ'] = 'rpc'
 patterns['SUB'] = 'pub'
 
 
+# truncated reprs (arguments may be megabytes of data)
+short = reprlib.Repr()
+short.maxstring = short.maxother = 80
+short.maxlist = short.maxtuple = short.maxdict = short.maxset = 10
+short.maxlevel = 3
+
 def format_args(args=[], kwargs={}):
-	args = [repr(i) for i in args]
-	kwargs = ['%s=%s' % (key, repr(value)) for key, value in kwargs.items()]
+	args = [short.repr(i) for i in args]
+	kwargs = ['%s=%s' % (key, short.repr(value)) for key, value in kwargs.items()]
 	return ', '.join(args + kwargs)
 
 def format_method(method, args=[], kwargs={}, clean=True):
@@ -24,3 +33,39 @@ def format_method(method, args=[], kwargs={}, clean=True):
 			return '(%s)' % format_args(args, kwargs)
 
 	return '.%s(%s)' % (method, format_args(args, kwargs))
+
+
+class Chain(object):
+	""" Request chain formatted when printed (log lines that aren't emitted cost nothing) """
+
+	def __init__(self, head='', requests=[]):
+		self.head  = head
+		self.parts = [(method, args, kwargs, True) for method, args, kwargs in requests]
+
+	def add(self, method, args=[], kwargs={}, clean=True):
+		self.parts.append((method, args, kwargs, clean))
+
+	def __str__(self):
+		return self.head + ''.join([format_method(*part) for part in self.parts])
+
+
+def pack_header(codec, **fields):
+	""" Header frame: codec name followed by optional ;key=value fields """
+	return ';'.join([codec] + ['%s=%s' % item for item in fields.items()])
+
+def parse_header(frame):
+	parts = frame.split(';')
+	return parts[0], dict(part.split('=', 1) for part in parts[1:])
+
+
+def spawn(func, *args, **kwargs):
+	""" gevent.spawn keeping the deadline and trace of the request being served """
+	current = gevent.getcurrent()
+	context = (getattr(current, 'deadline', None), getattr(current, 'trace', None))
+
+	def run():
+		greenlet = gevent.getcurrent()
+		greenlet.deadline, greenlet.trace = context
+		return func(*args, **kwargs)
+
+	return gevent.spawn(run)
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+
+# optional compressors
+try: import lz4.frame as lz4
+except ImportError: lz4 = None
+
+
+class Compressor(object):
+	""" Payload compression (the name travels in the z header field) """
+	name = None
+
+	def __init__(self):
+		# ratio and cpu time, to tell whether compression pays off
+		self.counters = dict(compressed=0, bytes_in=0, bytes_out=0, compress_time=0.0, decompressed=0,
+				decompress_time=0.0)
+
+	def compress(self, data):
+		start = time.time()
+		packed = self._compress(data)
+
+		self.counters['compressed']    += 1
+		self.counters['bytes_in']      += len(data)
+		self.counters['bytes_out']     += len(packed)
+		self.counters['compress_time'] += time.time() - start
+		return packed
+
+	def decompress(self, data):
+		start = time.time()
+		data = self._decompress(data)
+
+		self.counters['decompressed']    += 1
+		self.counters['decompress_time'] += time.time() - start
+		return data
+
+	def stats(self):
+		stats = dict(self.counters)
+		stats['ratio'] = float(stats['bytes_out']) / stats['bytes_in'] if stats['bytes_in'] else None
+		return stats
+
+
+class ZlibCompressor(Compressor):
+	name = 'zlib'
+
+	def _compress(self, data):
+		# fast level: we trade ratio for latency
+		return zlib.compress(data, 1)
+
+	def _decompress(self, data):
+		return zlib.decompress(data)
+
+
+class Lz4Compressor(Compressor):
+	name = 'lz4'
+
+	def _compress(self, data):
+		return lz4.compress(data)
+
+	def _decompress(self, data):
+		return lz4.decompress(data)
+
+
+# available compressors in order of preference
+compressors = [Lz4Compressor(), ZlibCompressor()]
+if lz4 is None:
+	compressors.pop(0)
+
+registry = dict((compressor.name, compressor) for compressor in compressors)
+
+# payloads smaller than threshold bytes are sent as they are
+threshold = 64 << 10
+
+
+def get_compressor(name):
+	""" Lookup compressor by name (as received in a header field) """
+	try: return registry[name]
+	except KeyError:
+		raise ValueError('Unknown compressor: %s' % name)
+
+def choose_compressor(advertised):
+	""" Pick the preferred compressor advertised by the other side (or None) """
+	for compressor in compressors:
+		if compressor.name in advertised:
+			return compressor
+
+	return None
+
+def accepted():
+	""" Value of the c header field: compressors we can decompress """
+	return ','.join(compressor.name for compressor in compressors)
+
+def stats():
+	return dict((compressor.name, compressor.stats()) for compressor in compressors)
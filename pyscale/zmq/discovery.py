@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import itertools
+import os
+import os.path as osp
+import time
+
+import gevent
+
+
+class Registry(object):
+	""" File-based registry of tcp endpoints (point it to a folder shared by all hosts) """
+
+	def __init__(self, path='tmp/registry', ttl=30, cache=2):
+		self.path  = path
+		self.ttl   = ttl   # entries not refreshed for ttl seconds are stale
+		self.cache = cache # seconds lookups are cached for
+
+		self.host = os.uname()[1]
+
+		self.lookups = {}  # name -> (endpoints, expires)
+		self.counter = itertools.count()
+
+	def entry(self, name, endpoint):
+		port = endpoint.rsplit(':', 1)[-1]
+		return osp.join(self.path, name, '%s-%s' % (self.host, port))
+
+	def register(self, name, endpoint):
+		""" Advertise endpoint (a bound tcp:// address) """
+		entry = self.entry(name, endpoint)
+		if not osp.isdir(osp.dirname(entry)):
+			os.makedirs(osp.dirname(entry))
+
+		with open(entry + '.tmp', 'w') as f:
+			f.write(endpoint.replace('*', self.host))
+		os.rename(entry + '.tmp', entry)
+
+	def unregister(self, name, endpoint):
+		try: os.remove(self.entry(name, endpoint))
+		except OSError:
+			pass
+
+	def heartbeat(self, name, endpoint):
+		""" Keep entry fresh while the module is alive """
+		while True:
+			self.register(name, endpoint)
+			gevent.sleep(self.ttl / 3.)
+
+	def names(self, pattern='*'):
+		""" Names of modules with fresh entries """
+		if not osp.isdir(self.path):
+			return []
+
+		return [name for name in fnmatch.filter(os.listdir(self.path), pattern) if self.endpoints(name)]
+
+	def endpoints(self, name):
+		""" Fresh endpoints for name, as (host, address) pairs """
+		cached = self.lookups.get(name)
+		if cached and cached[1] > time.time():
+			return cached[0]
+
+		endpoints = []
+		folder = osp.join(self.path, name)
+		for entry in fnmatch.filter(os.listdir(folder) if osp.isdir(folder) else [], '*-*[0-9]'):
+			path = osp.join(folder, entry)
+
+			try:
+				if os.stat(path).st_mtime + self.ttl < time.time():
+					continue
+
+				with open(path) as f:
+					endpoints.append((entry.rsplit('-', 1)[0], f.read().strip()))
+			except (IOError, OSError):
+				continue
+
+		self.lookups[name] = (endpoints, time.time() + self.cache)
+		return endpoints
+
+	def resolve(self, name, local):
+		""" Pick an address for name (round-robin), local ipc replaces our own host """
+		addresses = []
+		for host, address in self.endpoints(name):
+			if host == self.host and osp.exists(local[len('ipc://'):]):
+				address = local
+			addresses.append(address)
+
+		if not addresses:
+			return local
+
+		addresses = sorted(set(addresses))
+		return addresses[next(self.counter) % len(addresses)]
+
+
+# modules configure the path from config.app.Configuration.registry
+registry = Registry()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+
+
+class Histogram(object):
+	""" Log2-bucketed histogram (cheap to update, percentiles within a factor of 2) """
+
+	def __init__(self):
+		self.buckets = {} # exponent -> count of values in [2**(exponent-1), 2**exponent)
+		self.count   = 0
+		self.total   = 0
+		self.max     = 0
+
+	def add(self, value):
+		exponent = math.frexp(value)[1]
+		self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def percentile(self, q):
+		""" Upper bound of the bucket holding the q-th percentile """
+		rank = q / 100. * self.count
+		seen = 0
+
+		for exponent in sorted(self.buckets):
+			seen += self.buckets[exponent]
+			if seen >= rank:
+				return min(math.ldexp(1, exponent), self.max)
+
+		return self.max
+
+	def summary(self):
+		if not self.count:
+			return dict(count=0)
+
+		return dict(count=self.count, mean=self.total / float(self.count), max=self.max,
+				p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+
+class Metrics(object):
+	""" Per-method call counters and histograms (time in seconds, size in bytes) """
+
+	fields = ('execute', 'serialize', 'size')
+
+	def __init__(self):
+		self.methods = {} # method -> [calls, errors, {field: Histogram}]
+		self.wait    = Histogram()
+
+	def record(self, method, error=False, **values):
+		entry = self.methods.get(method)
+		if entry is None:
+			entry = self.methods[method] = [0, 0, dict((field, Histogram()) for field in self.fields)]
+
+		entry[0] += 1
+		if error:
+			entry[1] += 1
+
+		for field, value in values.items():
+			entry[2][field].add(value)
+
+	def summary(self):
+		methods = {}
+		for method, (calls, errors, histograms) in self.methods.items():
+			methods[method] = dict(calls=calls, errors=errors)
+			for field, histogram in histograms.items():
+				methods[method][field] = histogram.summary()
+
+		return dict(methods=methods, wait=self.wait.summary())
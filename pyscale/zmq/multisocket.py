@@ -6,37 +6,74 @@ import re
 import glob
 import os.path as osp
 
-from .common import patterns
+from gevent.event import Event
+
+from .common import patterns, spawn
 from .socket import Socket
+from .discovery import registry
+from ..lib import ReqError
 
 class MultiObject(object):
-	def __init__(self, lst):
+	""" Fan out operations to several objects concurrently """
+	reserved = ['objs', '_timeout', '_quorum']
+
+	def __init__(self, lst, timeout=None, quorum=None):
 		self.objs = lst
 
+		# underscored so targets' own timeout and quorum attributes stay reachable
+		self._timeout = timeout # seconds to wait for all (or quorum) results
+		self._quorum  = quorum  # return as soon as this many targets succeed
+
+	def _map(self, func):
+		""" Run func on all objects in parallel, failed targets yield ReqErrors """
+		greenlets = [spawn(func, obj) for obj in self.objs]
+		quorum = min(self._quorum or len(greenlets), len(greenlets))
+
+		done = Event()
+		def check(greenlet):
+			succeeded = [g for g in greenlets if g.successful() and not isinstance(g.value, ReqError)]
+			if len(succeeded) >= quorum or all(g.ready() for g in greenlets):
+				done.set()
+
+		for greenlet in greenlets:
+			greenlet.link(check)
+
+		if greenlets:
+			done.wait(self._timeout)
+
+		# partial results
+		objs = []
+		for greenlet in greenlets:
+			if greenlet.successful():
+				objs.append(greenlet.value)
+			elif greenlet.ready():
+				objs.append(ReqError(repr(greenlet.exception)))
+			else:
+				greenlet.kill(block=False)
+				objs.append(ReqError('cancelled' if done.is_set() else 'timeout'))
+
+		return MultiObject(objs, self._timeout, self._quorum)
+
 	# accessing attributes
 	def __getattr__(self, method):
-		objs = map(lambda x: getattr(x, method), self.objs)
-		return MultiObject(objs)
+		return self._map(lambda x: getattr(x, method))
 
 	def __setattr__(self, key, value):
-		if key == 'objs':
+		if key in self.reserved:
 			return super(MultiObject, self).__setattr__(key, value)
 
-		objs = map(lambda x: setattr(x, key, value), self.objs)
-		return MultiObject(objs)
+		return self._map(lambda x: setattr(x, key, value))
 
 	def __delattr__(self, key):
-		if key == 'objs':
-			return super(MultiObject, self).__setattr__(key, value)
+		if key in self.reserved:
+			return super(MultiObject, self).__delattr__(key)
 
-		objs = map(lambda x: delattr(x, key), self.objs)
-		return MultiObject(objs)
+		return self._map(lambda x: delattr(x, key))
 
 
 	# overloading
 	def __call__(self, *args, **kwargs):
-		objs = map(lambda x: x(*args, **kwargs), self.objs)
-		return MultiObject(objs)
+		return self._map(lambda x: x(*args, **kwargs))
 
 	def __str__(self):
 		return str(self.objs)
@@ -57,7 +94,7 @@ class MultiObject(object):
 class MultiSocket(object):
 	""" ZMQ multi-client for all messaging patterns"""
 
-	def __new__(cls, name, _type='REQ', subscription='', context=None):
+	def __new__(cls, name, _type='REQ', subscription='', context=None, timeout=None, quorum=None):
 		# extract (name, pattern) from sockfile
 		def parse(sockfile):
 			folder, name = osp.split(osp.splitext(sockfile)[0])
@@ -69,6 +106,11 @@ class MultiSocket(object):
 		socks = glob.glob("tmp/sockets/%s/%s.sock" % (patterns[_type], name))
 		socks = map(lambda x: parse(x), socks)
 
+		# modules advertised by other hosts
+		if _type == 'REQ':
+			local = set(sock[0] for sock in socks)
+			socks += [(i, _type) for i in registry.names(name) if i not in local]
+
 		socks = [Socket(i[0], i[1], subscription, context) for i in socks]
 
-		return MultiObject(socks)
+		return MultiObject(socks, timeout, quorum)
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import itertools
+import time
+
+import gevent
+from gevent.event import AsyncResult
+from gevent_zeromq import zmq
+
+from .common import pack_header, parse_header
+from .codec import get_codec
+from .compress import get_compressor
+
+
+class Pipeline(object):
+	""" Shared DEALER connection carrying many outstanding requests """
+
+	def __init__(self, name, address, codec, context):
+		self.name    = name
+		self.address = address
+		self.codec   = codec
+
+		self.sock = context.socket(zmq.DEALER)
+		self.sock.connect(address)
+
+		# outstanding requests by id
+		self.pending = {}
+		self.ids = itertools.count()
+
+		self.reader = gevent.spawn(self.read)
+
+	def send(self, blob, parse=lambda reply: reply, deadline=None, pack=None):
+		""" Send request, return AsyncResult set to parse(reply) """
+		rid = str(next(self.ids))
+
+		result = AsyncResult()
+		timer = None
+		if deadline is not None:
+			timer = gevent.spawn_later(max(deadline - time.time(), 0), self.expire, rid)
+
+		self.pending[rid] = (result, parse, timer)
+
+		# pack(codec, blob, deadline, **fields) returns [header][payload] with the caller's fields
+		if pack is None:
+			frames = [pack_header(self.codec.name, i=rid), self.codec.dumps(blob)]
+		else:
+			frames = pack(self.codec, blob, deadline, i=rid)
+
+		# mimic REQ sockets (empty delimiter) so the ROUTER broker is unaware of us
+		self.sock.send_multipart([''] + frames)
+		return result
+
+	def expire(self, rid):
+		try: result, parse, timer = self.pending.pop(rid)
+		except KeyError:
+			return
+
+		try: result.set(parse({'error': '%s: deadline exceeded' % self.name, 'expired': True}))
+		except Exception as ex:
+			result.set_exception(ex)
+
+	def read(self):
+		while True:
+			# reply: [empty][header][reply]
+			msg = self.sock.recv_multipart()
+			name, fields = parse_header(msg[1])
+
+			try: result, parse, timer = self.pending.pop(fields['i'])
+			except KeyError:
+				# requests that expired
+				logging.debug("[zmq] %s: late reply %s", self.address, msg[1])
+				continue
+
+			if timer is not None:
+				timer.kill(block=False)
+
+			try:
+				if 'z' in fields:
+					msg[2] = get_compressor(fields['z']).decompress(msg[2])
+
+				result.set(parse(get_codec(name).loads(msg[2])))
+			except Exception as ex:
+				result.set_exception(ex)
+
+	def close(self):
+		self.reader.kill()
+		self.sock.close()
+
+		for result, parse, timer in self.pending.values():
+			if timer is not None:
+				timer.kill(block=False)
+
+			result.set_exception(IOError('%s: connection closed' % self.address))
+		self.pending.clear()
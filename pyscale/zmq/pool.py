@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from gevent_zeromq import zmq
+
+from .pipeline import Pipeline
+from .cache import ReadThrough
+
+
+class SocketPool(object):
+	""" Context-level pool of client connections keyed by (name, type) """
+
+	instances = {}
+
+	@classmethod
+	def instance(cls, context):
+		if context not in cls.instances:
+			cls.instances[context] = cls(context)
+
+		return cls.instances[context]
+
+	def __init__(self, context, maxidle=8, timeout=60):
+		self.context = context
+		self.maxidle = maxidle # idle sockets kept per key
+		self.timeout = timeout # seconds before idle sockets are closed
+
+		self.idle        = {} # (name, type) -> [(sock, address, since)]
+		self.stamps      = {} # address -> server socket file stamp
+		self.codecs      = {} # address -> negotiated codec (None for legacy servers)
+		self.compressors = {} # address -> compressor the server accepts (or None)
+		self.pipelines   = {} # address -> shared DEALER connection
+		self.caches      = {} # address -> client cache (None for modules without one)
+
+		self.swept = time.time()
+
+	def acquire(self, key, address):
+		""" Get an idle socket connected to address or open a new one """
+		self.check(address)
+		self.evict()
+
+		idle = self.idle.get(key, [])
+		for idx in xrange(len(idle) - 1, -1, -1):
+			if idle[idx][1] == address:
+				return idle.pop(idx)[0]
+
+		sock = self.context.socket(getattr(zmq, key[1]))
+		sock.connect(address)
+		return sock
+
+	def release(self, key, address, sock, healthy=True):
+		""" Return a socket to the pool (sockets in a broken state are closed) """
+		idle = self.idle.setdefault(key, [])
+
+		if not healthy or sock.closed or len(idle) >= self.maxidle:
+			sock.close(linger=0)
+		else:
+			idle.append((sock, address, time.time()))
+
+	def pipeline(self, name, address, codec):
+		""" Shared DEALER connection for async requests """
+		self.check(address)
+
+		if address not in self.pipelines:
+			self.pipelines[address] = Pipeline(name, address, codec, self.context)
+
+		return self.pipelines[address]
+
+	def cache(self, name, address, methods):
+		""" Shared client cache of a module ({method: ttl} of its @cached methods) """
+		if address not in self.caches:
+			self.caches[address] = ReadThrough(name, methods, self.context) if methods else None
+
+		return self.caches[address]
+
+	# health checks
+	@staticmethod
+	def stamp(address):
+		if address.startswith('ipc://'):
+			try: stat = os.stat(address[len('ipc://'):])
+			except OSError:
+				return None
+
+			return (stat.st_ino, stat.st_mtime)
+
+	def check(self, address):
+		""" Drop connections to a server that restarted since we connected """
+		stamp = self.stamp(address)
+
+		if self.stamps.setdefault(address, stamp) != stamp:
+			self.stamps[address] = stamp
+			self.reset(address)
+
+	def reset(self, address):
+		for idle in self.idle.values():
+			for item in [item for item in idle if item[1] == address]:
+				idle.remove(item)
+				item[0].close(linger=0)
+
+		# restarted servers may speak other codecs and lost pending requests
+		self.codecs.pop(address, None)
+		self.compressors.pop(address, None)
+
+		pipeline = self.pipelines.pop(address, None)
+		if pipeline is not None:
+			pipeline.close()
+
+		cache = self.caches.pop(address, None)
+		if cache is not None:
+			cache.close()
+
+	def evict(self):
+		""" Close sockets idle for longer than timeout (at most once a second) """
+		now = time.time()
+		if now - self.swept < 1:
+			return
+
+		self.swept = now
+		for key, idle in self.idle.items():
+			self.idle[key] = [item for item in idle if now - item[2] < self.timeout]
+
+			for item in idle:
+				if now - item[2] >= self.timeout:
+					item[0].close(linger=0)
+
+	def close(self):
+		for address in set(self.stamps) | set(self.pipelines) | set(self.caches):
+			self.reset(address)
+
+		self.idle.clear()
+		self.stamps.clear()
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+import gevent
+import gevent.queue
+from gevent_zeromq import zmq
+
+from .common import pack_header, parse_header
+from .codec import codecs, get_codec
+
+
+class Publisher(object):
+	""" Module PUB socket fed from a bounded queue (messages beyond hwm are dropped)
+
+	Messages queued meanwhile are sent in one go, one zmq message per topic:
+	[topic][codec;s=seq][list of messages], seq counts the messages of the topic.
+	"""
+
+	def __init__(self, address, context, hwm=1000):
+		self.address = address
+		self.codec   = codecs[0]
+
+		self.sock = context.socket(zmq.PUB)
+		self.sock.set_hwm(hwm)
+		self.sock.bind(address)
+
+		self.queue = gevent.queue.Queue(hwm)
+		self.seqs  = {} # topic -> messages sent
+
+		self.counters = dict(published=0, dropped=0, sent=0)
+		self.sender = gevent.spawn(self.send)
+
+	def publish(self, topic, msg):
+		""" Queue msg for subscribers of topic (False if dropped) """
+		try: self.queue.put_nowait((topic, msg))
+		except gevent.queue.Full:
+			self.counters['dropped'] += 1
+			return False
+
+		self.counters['published'] += 1
+		return True
+
+	def send(self):
+		while True:
+			batch = [self.queue.get()]
+			while not self.queue.empty():
+				batch.append(self.queue.get_nowait())
+
+			topics = {}
+			for topic, msg in batch:
+				topics.setdefault(topic, []).append(msg)
+
+			for topic, msgs in topics.items():
+				seq = self.seqs.get(topic, 0)
+				self.seqs[topic] = seq + len(msgs)
+
+				self.sock.send_multipart([topic, pack_header(self.codec.name, s=seq), self.codec.dumps(msgs)])
+				self.counters['sent'] += 1
+
+	def close(self):
+		self.sender.kill()
+		self.sock.close()
+
+
+class Subscriber(object):
+	""" Consumer of the messages a module publishes on topic (a prefix, '' for all)
+
+	handler(topic, msg) is called per message, or handler([(topic, msg), ...])
+	with up to batch messages. Messages beyond hwm are dropped while the handler
+	is busy; lost counts the messages the publisher dropped or never delivered.
+	"""
+
+	def __init__(self, name, topic, handler, context, hwm=1000, batch=None):
+		self.name    = name
+		self.topic   = topic
+		self.handler = handler
+		self.batch   = batch
+
+		self.sock = context.socket(zmq.SUB)
+		self.sock.set_hwm(hwm)
+		self.sock.connect("ipc://tmp/sockets/pub/%s.sock" % name)
+		self.sock.setsockopt(zmq.SUBSCRIBE, topic)
+
+		self.queue = gevent.queue.Queue(hwm)
+		self.seqs  = {} # topic -> next expected seq
+
+		self.counters = dict(received=0, dropped=0, lost=0)
+
+	def read(self):
+		while True:
+			msg = self.sock.recv_multipart()
+			topic = msg[0]
+
+			# reserved topics (e.g. cache invalidations)
+			if topic.startswith('__'):
+				continue
+
+			codec, fields = parse_header(msg[1])
+			msgs = get_codec(codec).loads(msg[2])
+
+			# gaps in the sequence (publishers restarting start over)
+			seq = int(fields['s'])
+			if seq > self.seqs.get(topic, seq):
+				self.counters['lost'] += seq - self.seqs[topic]
+			self.seqs[topic] = seq + len(msgs)
+
+			for item in msgs:
+				try: self.queue.put_nowait((topic, item))
+				except gevent.queue.Full:
+					self.counters['dropped'] += 1
+				else:
+					self.counters['received'] += 1
+
+	def consume(self):
+		while True:
+			items = [self.queue.get()]
+			while self.batch and len(items) < self.batch and not self.queue.empty():
+				items.append(self.queue.get_nowait())
+
+			try:
+				if self.batch:
+					self.handler(items)
+				else:
+					self.handler(*items[0])
+			except Exception:
+				logging.exception("[zmq] %s/%s: subscriber failed" % (self.name, self.topic))
+
+	def close(self):
+		self.sock.close()
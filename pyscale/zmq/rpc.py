@@ -1,7 +1,15 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
+import itertools
 import logging
+import multiprocessing
+import os
+import os.path as osp
+import random
+import signal
+import time
 import traceback
 
 import gevent
@@ -14,26 +22,60 @@ import types
 types.MethodWrapper = type(object().__getattribute__)
 
 # library
-from .common import format_method
+from .common import Chain, pack_header, parse_header
+from .codec import codecs, default, get_codec
+from .compress import compressors, get_compressor, choose_compressor, stats as compression_stats
+from .discovery import registry
+from .scaling import ScalingPolicy, FixedPolicy
+from .shm import Segments
+from .metrics import Metrics
+from .tracing import Tracer, new_id
 from ..lib import PyscaleError, ReqError
 
-# let zmq select jsonapi (for performance)
-from zmq.utils import jsonapi
-if jsonapi.jsonmod is None:
-	raise ImportError('jsonlib{1,2}, json or simplejson library is required.')
-
 
 class RpcWorker(gevent.Greenlet):
 	""" zmq RPC Worker """
 
-	def __init__(self, server):
+	def __init__(self, server, address="inproc://workers"):
 		super(RpcWorker, self).__init__()
 
-		self.server = server
+		self.server  = server
+		self.address = address
+		self.codec   = None
+		self.batched = False
+
+		# the caller runs on this host (large results go through shared memory)
+		self.local = False
+
+		# compressor for large replies (the caller accepts it)
+		self.compressor = None
+
+		# pre-encoded replies of the cache entry being returned ({codec: bytes})
+		self.encoded = None
+
+		# absolute deadline of the current request (propagated to nested requests)
+		self.deadline = None
+
+		# connection to the cpu worker processes
+		self.cpu = None
+
+		# metrics of the current request: method called, serialization (time, size), replied with a proxy
+		self.method     = None
+		self.serialized = None
+		self.proxied    = False
+
+		# (trace, span) of the current request (propagated to nested requests), caller span
+		self.trace  = None
+		self.caller = None
+
+		# parts of the last chain handled (labels handles to its result)
+		self.parts = None
 
 	def _run(self):
 		self.sock = self.server.context.socket(zmq.REQ)
-		self.sock.connect("inproc://workers")
+		if getattr(self.server, 'identity', None):
+			self.sock.setsockopt(zmq.IDENTITY, self.server.identity)
+		self.sock.connect(self.address)
 
 		self.sock.send('READY')
 
@@ -46,26 +88,108 @@ class RpcWorker(gevent.Greenlet):
 			if req is None:
 				# kill me if you dare
 				break
+			elif self.expired():
+				# the caller gave up already
+				self.send(envelope, 'deadline exceeded', error=True)
 			else:
 				# love me, i don't care
-				try: reply = self.handle(req)
+				self.batched = bool(req) and req[0][0] == '__batch'
+				self.method = req[0][0] if req else ''
+
+				start = time.time()
+				try:
+					if self.batched:
+						reply = self.batch(*req[0][1])
+					else:
+						reply = self.handle(req)
 				except ReqError as e:
+					elapsed, error = time.time() - start, True
 					self.send(envelope, e.msg, error=True)
 				else:
+					elapsed, error = time.time() - start, False
 					self.send(envelope, reply)
 
+				# a lookup answered with a proxy is the first round trip of a sync call (counted with the call)
+				lookup = self.proxied and all(step[0] in ('__getattribute__', '__handle') for step in req)
+
+				metrics = getattr(self.server, 'metrics', None)
+				if metrics is not None and not lookup:
+					serialize, size = self.serialized
+					metrics.record(self.method, error, execute=elapsed, serialize=serialize, size=size)
+
+				if self.trace is not None and not lookup:
+					self.server.tracer.record(self.trace[0], self.trace[1], self.caller, self.method, start, elapsed, error)
+
+				threshold = getattr(self.server, 'slow_threshold', None)
+				if threshold is not None and elapsed >= threshold and random.random() < self.server.slow_sample:
+					logging.warning("[zmq] slow request (%.1f ms): %s", elapsed * 1000, self.chain(self.server.module.name, req),
+						extra=dict(latency=elapsed))
+
+	def batch(self, chains):
+		""" Execute independent request chains, collecting results and errors """
+		replies = []
+
+		for chain in chains:
+			if self.expired():
+				replies.append({'error': 'deadline exceeded', 'expired': True})
+				continue
+
+			try: replies.append({'result': self.handle(chain)})
+			except ReqError as e:
+				replies.append({'error': e.msg})
+
+		return replies
+
+	def chain(self, head, requests):
+		""" Chain for logs, a continued handle shows as the chain that returned it """
+		if requests and requests[0][0] == '__handle':
+			chain = Chain(head, requests[1:])
+			chain.parts[:0] = self.server.handles.label(*requests[0][1])
+			return chain
+
+		return Chain(head, requests)
+
 	def handle(self, requests):
-		logging.debug("[zmq] <~ self%s" % ''.join([format_method(*req) for req in requests]))
+		logging.debug("[zmq] <~ self%s", self.chain('', requests))
 
 		# loop request chain
 		module = self.server.module
 		result = module
-		parsed = module.name
+		parsed = Chain(module.name)
+		handle = None
+		self.parts = parsed.parts
 
 		for method, args, kwargs in requests:
+			self.encoded = None
+			if not self.batched:
+				self.method = method
+
 			# parse request
 			try:
-				if method == '__dir':
+				if method == '__codecs':
+					# compressor names follow (clients pick from the names they know)
+					result = [codec.name for codec in codecs] + [compressor.name for compressor in compressors]
+				elif method == '__cacheable':
+					# @cached methods and their ttl, for client caches
+					result = getattr(module, 'cacheable', {})
+				elif method == '__stats':
+					# latency and throughput metrics (see cake stats)
+					result = self.server.summary()
+				elif method == '__trace':
+					# spans of a trace, or recent traces (see cake trace)
+					result = self.server.tracer.find(*args, **kwargs)
+				elif method == '__handle':
+					parsed.parts.extend(self.server.handles.label(*args, **kwargs))
+					result = self.server.handles.resolve(*args, **kwargs)
+					handle = args[0]
+				elif method == '__next':
+					# next chunk of a streamed iterator, the client asks for as many items as it can take
+					parsed.add(method, args, kwargs, clean=False)
+					result = list(itertools.islice(result, *args))
+
+					if len(result) < args[0] and handle is not None:
+						self.server.handles.release(handle)
+				elif method == '__dir':
 					result = dir(result, *args, **kwargs)
 				elif method == '__len':
 					result = len(result, *args, **kwargs)
@@ -74,66 +198,321 @@ class RpcWorker(gevent.Greenlet):
 				elif method == '__del':
 					result = delattr(result, *args, **kwargs)
 				else:
-					try: result = getattr(result, method)
+					try: func = getattr(result, method)
 					except AttributeError:
-						parsed += '.' + method
+						parsed.add('__getattribute__', [method])
 						raise
 					else:
-						parsed += format_method(method, args, kwargs)
-						result = result(*args, **kwargs)
+						parsed.add(method, args, kwargs)
+
+						target = result if method == '__call__' else func
+						bound  = getattr(target, 'im_self', None)
+						cache  = getattr(target, 'cache', None) if bound is not None else None
+
+						if self.batched:
+							pass
+						elif method == '__getattribute__':
+							self.method = args[0]
+						else:
+							self.method = getattr(target, '__name__', method)
+
+						if self.server.processes and getattr(target, 'cpu', False) and bound is module:
+							# cpu-bound module methods run in worker processes
+							call = lambda: self.offload(target.__name__, args, kwargs)
+						elif cache is not None:
+							call = lambda: target.uncached(bound, *args, **kwargs)
+						else:
+							call = lambda: func(*args, **kwargs)
+
+						if cache is not None:
+							# @cached methods: hits reuse the encoded reply of the first miss
+							result, expires, self.encoded = cache.entry(cache.key(args, kwargs), call)
+						else:
+							result = call()
 			except AttributeError:
 				msg = 'AttributeError: \'%s\'' % parsed
 				logging.error(msg)
 				module.alert(msg)
-				raise ReqError(parsed)
+				raise ReqError(str(parsed))
 			except PyscaleError as ex:
 				msg = ''.join(traceback.format_exception_only(type(ex), ex)).strip()
 				logging.error(msg)
 				module.alert(msg)
-				raise ReqError(parsed)
+				raise ReqError(str(parsed))
 			except Exception as ex:
 				msg = traceback.format_exc()
 				logging.exception(msg)
 				module.error(msg)
-				raise ReqError(parsed)
+				raise ReqError(str(parsed))
 
 		return result
 
+	def expired(self):
+		return self.deadline is not None and self.deadline <= time.time()
+
+	def offload(self, method, args, kwargs):
+		""" Call module method in the next idle worker process """
+		if not self.server.processes.pids:
+			raise PyscaleError('no worker processes left')
+
+		if self.cpu is None:
+			self.cpu = self.server.context.socket(zmq.REQ)
+			self.cpu.connect(self.server.processes.frontend)
+
+		codec, fields = codecs[0], {}
+		if self.deadline is not None:
+			fields['d'] = '%.3f' % (self.deadline - time.time())
+
+		self.cpu.send_multipart([pack_header(codec.name, **fields), codec.dumps([(method, args, kwargs)])])
+
+		if self.deadline is not None and not self.cpu.poll(max(self.deadline - time.time(), 0) * 1000):
+			# expired requests are dropped, the socket won't get a reply
+			self.cpu.close(linger=0)
+			self.cpu = None
+			raise PyscaleError('deadline exceeded')
+
+		header, reply = self.cpu.recv_multipart()
+		reply = get_codec(parse_header(header)[0]).loads(reply)
+
+		if 'error' in reply:
+			raise PyscaleError('worker process failed: %s' % reply['error'])
+		elif 'proxy' in reply:
+			raise PyscaleError('worker process returned non-serializable %s' % reply['proxy'])
+
+		return reply['result']
+
 	def recv(self):
-		envelope = self.sock.recv_multipart()
-		msg = jsonapi.loads(envelope.pop())
+		while True:
+			# request: [client][empty][header][req] or [client][empty][req] (legacy json)
+			envelope = self.sock.recv_multipart()
+			msg = envelope.pop()
+
+			self.codec = None
+			self.deadline = None
+			self.encoded = None
+			self.local = False
+			self.compressor = None
+			self.trace = self.caller = None
+
+			if len(envelope) > 2:
+				header = envelope.pop()
+				name, fields = parse_header(header)
+
+				if 'd' in fields:
+					self.deadline = time.time() + float(fields['d'])
+
+				self.local = 'm' in fields
+
+				if 'c' in fields:
+					self.compressor = choose_compressor(fields['c'].split(','))
+
+				if 't' in fields:
+					trace, span, parent = fields['t'].split(':')
+					self.trace, self.caller = (trace, span), parent or None
+
+				try:
+					self.codec = get_codec(name)
+
+					if 'z' in fields:
+						msg = get_compressor(fields.pop('z')).decompress(msg)
+						header = pack_header(name, **fields)
+				except Exception as ex:
+					# unknown codec or compressor (or corrupt payload): reply using a codec every client understands
+					self.codec = default
+					self.compressor = None
+					fields.pop('z', None)
+					self.send(envelope + [pack_header(default.name, **fields)], str(ex), error=True)
+					continue
+
+				envelope.append(header)
+
+			# start traces for a sample of the requests
+			tracer = getattr(self.server, 'tracer', None)
+			if self.trace is None and tracer is not None and tracer.sampled():
+				self.trace = (new_id(), new_id())
+
+			try: req = (self.codec or default).loads(msg)
+			except Exception as ex:
+				# reply instead of dying (the caller would wait forever)
+				self.send(envelope, 'Invalid request: %s' % ex, error=True)
+				continue
 
-		return envelope, msg
+			return envelope, req
 
 	def send(self, envelope, msg, error=False):
+		codec = self.codec or default
+		start = time.time()
+		self.proxied = False
+
 		if error:
-			msg = jsonapi.dumps({'error': msg})
+			msg = codec.dumps({'error': msg})
 		else:
-			# FIXME: exception handling should be better done
-			# but there are too many json libraries out there
-			try: msg = jsonapi.dumps({'result': msg})
-			except Exception:
-				msg = jsonapi.dumps({'proxy': repr(msg)})
+			segments = getattr(self.server, 'segments', None)
+			encoded = None if self.batched else self.encoded
+
+			if self.local and segments is not None and not self.batched and isinstance(msg, (str, bytearray, buffer)) \
+					and len(msg) >= segments.threshold:
+				msg = codec.dumps({'shm': segments.write(msg)})
+			elif encoded is not None and codec.name in encoded:
+				msg = encoded[codec.name]
+			else:
+				# FIXME: exception handling should be better done
+				# but there are too many serializers out there
+				try: msg = codec.dumps({'result': msg})
+				except Exception:
+					if self.batched:
+						msg = codec.dumps({'result': [self.serializable(codec, item) for item in msg]})
+					else:
+						msg = codec.dumps(self.proxy(msg, self.parts))
+						self.proxied = True
+				else:
+					if encoded is not None:
+						encoded[codec.name] = msg
+
+		threshold = getattr(self.server, 'compress_threshold', None)
+		if self.compressor is not None and threshold is not None and len(msg) >= threshold:
+			name, fields = parse_header(envelope[-1])
+			fields['z'] = self.compressor.name
+
+			envelope[-1] = pack_header(name, **fields)
+			msg = self.compressor.compress(msg)
+
+		self.serialized = (time.time() - start, len(msg))
 
 		envelope.append(msg)
 		return self.sock.send_multipart(envelope)
 
+	def serializable(self, codec, reply):
+		try: codec.dumps(reply)
+		except Exception:
+			return self.proxy(reply['result'])
+
+		return reply
+
+	def proxy(self, obj, parts=None):
+		# clients continue chained requests from the handle (and page through iterators)
+		reply = {'proxy': repr(obj), 'handle': self.server.handles.register(obj, parts)}
+		if isinstance(obj, collections.Iterator):
+			reply['stream'] = True
+
+		return reply
+
+
+class HandleTable(object):
+	""" Leased references to non-serializable results """
+
+	def __init__(self, lease=60):
+		self.lease = lease
+
+		self.handles = {} # handle -> [obj, key, expires, chain parts that returned obj]
+		self.keys    = {} # object key -> handle
+
+		# unique across restarts so stale clients can't hit other objects
+		self.prefix = os.urandom(4).encode('hex')
+		self.ids    = itertools.count()
+
+	@staticmethod
+	def key(obj):
+		# bound methods are recreated on every attribute access
+		if isinstance(obj, types.MethodType):
+			return (id(obj.im_self), obj.im_func)
+
+		return id(obj)
+
+	def register(self, obj, parts=None):
+		key = self.key(obj)
+
+		handle = self.keys.get(key)
+		if handle is None:
+			handle = self.keys[key] = '%s.%d' % (self.prefix, next(self.ids))
+
+		self.handles[handle] = [obj, key, time.time() + self.lease, parts]
+		return handle
+
+	def label(self, handle):
+		""" Chain parts that returned the object (for logs and errors) """
+		entry = self.handles.get(handle)
+		if entry is None or entry[3] is None:
+			return [('__handle', [handle], {}, False)]
+
+		return entry[3]
+
+	def resolve(self, handle):
+		try: entry = self.handles[handle]
+		except KeyError:
+			raise PyscaleError('Expired handle: %s' % handle)
+
+		# renew lease
+		entry[2] = time.time() + self.lease
+		return entry[0]
+
+	def release(self, handle):
+		try: obj, key, expires, parts = self.handles.pop(handle)
+		except KeyError:
+			return
+
+		del self.keys[key]
+
+	def collect(self):
+		while True:
+			gevent.sleep(self.lease / 2.)
+
+			now = time.time()
+			for handle, (obj, key, expires, parts) in self.handles.items():
+				if expires < now:
+					del self.handles[handle]
+					del self.keys[key]
+
 
 class RpcServer(object):
 	""" zmq RPC Server featuring Router-to-Router broker (LRU queue) """
 
-	def __init__(self, module, address, ready_workers=1, max_workers=float('inf'), context=None):
+	def __init__(self, module, address, ready_workers=1, max_workers=64, handle_lease=60, tcp=None, policy=None,
+			max_pending=1024, hwm=None, weights=None, shm_threshold=None, compress_threshold=None,
+			trace_sample=0.0, slow_threshold=None, slow_sample=1.0, context=None):
 		self.module  = module
 		self.address = address
 		self.context = context or zmq.Context.instance()
 
-		self.ready_workers = ready_workers
-		self.max_workers   = max_workers
+		# optional tcp endpoint (e.g. tcp://*:5555, or tcp://* for a random port)
+		self.tcp      = tcp
+		self.endpoint = None
+
+		# worker autoscaling
+		self.policy = policy or ScalingPolicy(ready_workers, max_workers)
+
+		# admission control: queued requests beyond max_pending are rejected
+		self.max_pending = max_pending
+		self.hwm         = hwm
+
+		# priority lanes: {priority: weight} for weighted fair queuing, None for strict priority
+		self.weights = weights
+
+		# results of at least shm_threshold bytes for same-host callers (None disables)
+		self.segments = Segments(module.name, threshold=shm_threshold) if shm_threshold else None
+
+		# replies of at least compress_threshold bytes for callers accepting compression (None disables)
+		self.compress_threshold = compress_threshold
 
 		self.workers = gevent.pool.Group()
+		self.handles = HandleTable(handle_lease)
+
+		# worker processes for @api(cpu=True) methods
+		self.processes = None
+
+		# per-method latencies and sizes
+		self.metrics = Metrics()
+		self.started = time.time()
+
+		# spans of traced requests
+		self.tracer = Tracer(module.name, sample=trace_sample)
+
+		# log a sample of the requests taking slow_threshold seconds or more
+		self.slow_threshold = slow_threshold
+		self.slow_sample    = slow_sample
 
 	def spawn_worker(self):
-		if len(self.workers) < self.max_workers:
+		if len(self.workers) < self.policy.max_workers:
 			# we keep track of workers internally
 			worker = RpcWorker(self)
 			self.workers.start(worker)
@@ -146,77 +525,403 @@ class RpcServer(object):
 		# for debugging purposes
 		return [getattr(worker, '_ready', None) for worker in self.workers]
 
+	@property
+	def stats(self):
+		""" Worker scaling statistics (tune the policy with these) """
+		return self.broker.stats
+
+	@property
+	def compression(self):
+		""" Compression ratio and cpu time of this process (requests and replies) """
+		return compression_stats()
+
+	def summary(self):
+		""" Metrics, worker and compression stats (the __stats reply) """
+		summary = self.metrics.summary()
+		summary.update(uptime=time.time() - self.started, broker=self.stats, compression=self.compression)
+		return summary
+
+	def fork(self):
+		""" Fork the replicas running @api(cpu=True) methods (once the module is constructed) """
+		methods = [func for base in type(self.module).__mro__ for func in base.__dict__.values()]
+		if any(getattr(func, 'cpu', False) for func in methods):
+			processes = getattr(self.module, 'processes', None) or multiprocessing.cpu_count()
+			self.processes = ProcessPool(self, processes)
+			self.processes.run()
+
 	def run(self):
 		# spawn workers
-		for i in xrange(self.ready_workers):
+		for i in xrange(self.policy.min_workers):
 			self.spawn_worker()
 
+		# expire remote object handles and shared memory segments
+		self.module.jobs.spawn(self.handles.collect)
+		if self.segments:
+			self.module.jobs.spawn(self.segments.sweep)
+
 		# create broker
 		clients = self.context.socket(zmq.XREP)
+		if self.hwm is not None:
+			clients.set_hwm(self.hwm)
 		clients.bind(self.address)
 
+		if self.tcp:
+			if self.tcp.count(':') < 2:
+				self.endpoint = '%s:%s' % (self.tcp, clients.bind_to_random_port(self.tcp))
+			else:
+				clients.bind(self.tcp)
+				self.endpoint = self.tcp
+
+			# advertise endpoint to other hosts
+			self.module.jobs.spawn(registry.heartbeat, self.module.name, self.endpoint)
+
 		workers = self.context.socket(zmq.XREP)
 		workers.bind("inproc://workers")
 
 		# XXX: zmq devices don't work with gevent
 		# zmq.device(zmq.QUEUE, clients, workers)
+		self.broker = RpcBroker(clients, workers, self, self.max_pending, self.weights)
+
+	def close(self):
+		if self.endpoint:
+			registry.unregister(self.module.name, self.endpoint)
+
+		if self.processes:
+			self.processes.close()
+
+
+class ProcessPool(object):
+	""" Pre-forked module replicas running cpu-bound methods (LRU across processes) """
+
+	frontend = "inproc://cpu"
+
+	def __init__(self, server, processes):
+		self.module  = server.module
+		self.context = server.context
+		self.address = "ipc://tmp/sockets/cpu/%s.sock" % self.module.name
+
+		# processes are never spawned or killed by the broker
+		self.policy = FixedPolicy(processes)
+
+		# replicas call cpu methods inline
+		self.processes = None
+
+		self.pids = []
+		for i in xrange(processes):
+			pid = os.fork()
+			if pid == 0:
+				self.child()
+			else:
+				self.pids.append(pid)
+
+	def child(self):
+		parent = os.getppid()
+
+		# greenlets of the parent must not run here: start over with a new hub
+		gevent.get_hub().destroy(destroy_loop=True)
+
+		# the parent context must not be used after fork
+		self.context = zmq.Context()
+		self.module.context = self.context
+		self.handles = HandleTable()
+
+		# known to the parent, which drops the replica from its broker if it dies
+		self.identity = self.replica(os.getpid())
+
+		worker = RpcWorker(self, self.address)
+		worker.start()
+
+		# exit along with the parent
+		while os.getppid() == parent and not worker.ready():
+			gevent.sleep(1)
+
+		# atexit handlers don't run (write buffered log records)
+		logging.shutdown()
+		os._exit(0)
+
+	@staticmethod
+	def replica(pid):
+		return 'cpu-%d' % pid
+
+	@property
+	def workers(self):
+		return self.pids
+
+	def spawn_worker(self):
+		# processes are forked upfront, requests wait for the next idle one
+		pass
+
+	def run(self):
+		if not osp.isdir('tmp/sockets/cpu'):
+			os.makedirs('tmp/sockets/cpu')
+
+		clients = self.context.socket(zmq.XREP)
+		clients.bind(self.frontend)
+
+		workers = self.context.socket(zmq.XREP)
+		workers.bind(self.address)
+
 		self.broker = RpcBroker(clients, workers, self)
+		self.module.jobs.spawn(self.monitor)
+
+	def monitor(self):
+		while self.pids:
+			gevent.sleep(1)
+
+			for pid in list(self.pids):
+				try: done = os.waitpid(pid, os.WNOHANG)[0]
+				except OSError:
+					done = pid
+
+				if done:
+					self.pids.remove(pid)
+
+					# no more requests for it, the one it was running fails
+					self.broker.remove(self.replica(pid))
+
+					msg = 'worker process %s died' % pid
+					logging.error(msg)
+					self.module.alert(msg)
+
+	def close(self):
+		for pid in self.pids:
+			try: os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+		self.pids = []
+
+
+class Lanes(object):
+	""" Pending requests by priority (strict priority or weighted fair queuing) """
+
+	def __init__(self, weights=None):
+		self.weights = weights # {priority: weight}, None for strict priority
+		self.lanes   = {}      # priority -> deque of items
+		self.passes  = {}      # priority -> virtual time of its next turn
+		self.vtime   = 0.0
+
+		# one token per queued item (get blocks on it)
+		self.tokens = gevent.queue.Queue()
+
+	def put(self, item, priority=0):
+		lane = self.lanes.setdefault(priority, collections.deque())
+		if not lane:
+			# idle lanes don't save up turns
+			self.passes[priority] = max(self.passes.get(priority, 0.0), self.vtime)
+
+		lane.append(item)
+		self.tokens.put(None)
+
+	def get(self):
+		self.tokens.get()
+		busy = [priority for priority, lane in self.lanes.iteritems() if lane]
+
+		if self.weights is None:
+			priority = max(busy)
+		else:
+			priority = min(busy, key=lambda p: self.passes[p])
+			self.vtime = self.passes[priority]
+			self.passes[priority] += 1.0 / self.weights.get(priority, 1)
+
+		return self.lanes[priority].popleft()
+
+	def evict(self, priority):
+		""" Remove the newest item of the lowest lane below priority (or None) """
+		lower = [p for p, lane in self.lanes.iteritems() if lane and p < priority]
+		if not lower:
+			return None
+
+		self.tokens.get_nowait()
+		return self.lanes[min(lower)].pop()
+
+	def qsize(self):
+		return self.tokens.qsize()
+
+	def depths(self):
+		# string keys for codecs that only take string map keys
+		return dict((str(priority), len(lane)) for priority, lane in self.lanes.iteritems())
 
 
 class RpcBroker(object):
-	""" zmq gevent-compatible LRU Queue Device """
+	""" zmq gevent-compatible worker queue device (most recently used worker first) """
 
-	def __init__(self, clients, workers, server):
+	def __init__(self, clients, workers, server, max_pending=None, weights=None):
 		self.clients = clients
 		self.workers = workers
 		self.server  = server
+		self.policy  = server.policy
+
+		self.max_pending = max_pending
+
+		# here we keep track of idle workers (since, worker)
+		# surplus workers stay at the bottom and retire once idle for long enough
+		self.ready = gevent.queue.LifoQueue()
+
+		# requests waiting for a worker (received, deadline, msg) by priority
+		self.pending = Lanes(weights)
+
+		# request each busy worker is running (worker -> msg)
+		self.assigned = {}
 
-		# here we keep track of idle workers
-		self.ready = gevent.queue.Queue()
+		# statistics
+		self.busy     = 0
+		self.wait     = 0.0
+		self.counters = dict(requests=0, shed=0, expired=0, spawned=0, retired=0, peak=len(server.workers))
 
 		# spawn jobs that redirect requests from clients to workers and back
 		self.jobs = gevent.pool.Group()
-		fwd = self.jobs.spawn(self.forward)
-		bwd = self.jobs.spawn(self.backward)
+		for job in [self.forward, self.dispatch, self.backward, self.reap]:
+			self.server.module.jobs.add(self.jobs.spawn(job))
 
-		self.server.module.jobs.add(fwd)
-		self.server.module.jobs.add(bwd)
+	@property
+	def stats(self):
+		workers = len(self.server.workers)
+		ready   = self.ready.qsize()
+
+		stats = dict(self.counters)
+		stats.update(
+			workers  = workers,
+			ready    = ready,
+			busy     = self.busy,
+			starting = max(workers - ready - self.busy, 0),
+			queued   = self.pending.qsize(),
+			lanes    = self.pending.depths(),
+			wait     = self.wait,
+		)
+		return stats
 
 	def forward(self):
 		while True:
-			# client request: [client][empty][req]
+			# client request: [client][empty]([header])[req]
 			msg = self.clients.recv_multipart()
 
 			# assertions
 			assert msg[1] == ''
 
-			# spawn additional worker if none available
-			if self.ready.empty():
+			self.counters['requests'] += 1
+
+			# relative deadline (clocks of other hosts may differ) and priority
+			deadline, priority = None, 0
+			if len(msg) > 3:
+				fields = parse_header(msg[2])[1]
+				if 'd' in fields:
+					deadline = time.time() + float(fields['d'])
+				if 'p' in fields:
+					priority = int(fields['p'])
+
+			# shed load instead of queueing without bounds (lowest priority first)
+			if self.max_pending is not None and self.pending.qsize() >= self.max_pending:
+				self.counters['shed'] += 1
+
+				evicted = self.pending.evict(priority)
+				if evicted is None:
+					self.clients.send_multipart(self.reject(msg, 'overloaded', overloaded=True))
+					continue
+
+				self.clients.send_multipart(self.reject(evicted[2], 'overloaded', overloaded=True))
+
+			self.pending.put((time.time(), deadline, msg), priority)
+
+			# spawn additional worker if the policy says so
+			if self.policy.spawn(self.stats):
 				self.server.spawn_worker()
+				self.counters['spawned'] += 1
+				self.counters['peak'] = max(self.counters['peak'], len(self.server.workers))
+
+	def reject(self, msg, error, **flags):
+		""" Error reply for a request the broker gives up on (same envelope and codec) """
+		reply, codec = msg[:2], default
+
+		if len(msg) > 3:
+			name, fields = parse_header(msg[2])
+			try: codec = get_codec(name)
+			except ValueError:
+				pass
+
+			# the reply isn't compressed
+			fields.pop('z', None)
+			reply.append(pack_header(codec.name, **fields))
+
+		flags['error'] = '%s: %s' % (self.server.module.name, error)
+		reply.append(codec.dumps(flags))
+		return reply
+
+	def dispatch(self):
+		while True:
+			# wait for a ready worker first, requests queued meanwhile compete for it
+			self.ready.peek()
+			received, deadline, msg = self.pending.get()
+
+			# get the ready worker and pass request
+			since, worker = self.ready.get()
+
+			if deadline is not None:
+				now = time.time()
+				if deadline <= now:
+					# the caller gave up: drop request and keep the worker
+					self.ready.put((since, worker))
+					self.counters['expired'] += 1
+					continue
+
+				name, fields = parse_header(msg[2])
+				fields['d'] = '%.3f' % (deadline - now)
+				msg[2] = pack_header(name, **fields)
 
-			# get a ready worker and pass request
-			worker = self.ready.get()
 			self.workers.send_multipart([worker, ''] + msg)
+			self.assigned[worker] = msg
+			self.busy += 1
+
+			# moving average of the time requests wait for a worker
+			wait = time.time() - received
+			self.wait = 0.9 * self.wait + 0.1 * wait
+
+			metrics = getattr(self.server, 'metrics', None)
+			if metrics is not None:
+				metrics.wait.add(wait)
 
 	def backward(self):
 		while True:
-			# worker response: [worker][empty][ready] or [worker][empty][client][empty][reply]
+			# worker response: [worker][empty][ready] or [worker][empty][client][empty]([header])[reply]
 			msg = self.workers.recv_multipart()
 
 			# assertions
 			assert msg[1] == ''
-			assert len(msg) == 3 or (len(msg) == 5 and msg[3] == '')
+			assert len(msg) == 3 or (len(msg) in (5, 6) and msg[3] == '')
 
 			# route reply back to client
 			if msg[2] != 'READY':
 				self.clients.send_multipart(msg[2:])
+				self.assigned.pop(msg[0], None)
+				self.busy -= 1
+
+			# keep worker (mark as ready)
+			self.ready.put((time.time(), msg[0]))
+
+	def remove(self, worker):
+		""" Forget a worker that died (its request fails) """
+		for item in list(self.ready.queue):
+			if item[1] == worker:
+				self.ready.queue.remove(item)
 
-			# decide worker fate
-			worker = msg[0]
+		msg = self.assigned.pop(worker, None)
+		if msg is not None:
+			self.clients.send_multipart(self.reject(msg, 'worker died'))
+			self.busy -= 1
+
+	def reap(self):
+		while True:
+			gevent.sleep(max(self.policy.idle_timeout / 2., 1))
+
+			# retire surplus workers that stayed idle (bottom of the stack)
+			now, stats = time.time(), self.stats
+			while self.ready.qsize() and self.policy.retire(now - self.ready.queue[0][0], stats):
+				since, worker = self.ready.queue.pop(0)
 
-			if self.ready.qsize() >= max(self.server.ready_workers, 1):
 				# kill worker (send None as request)
-				self.workers.send_multipart([worker, '', jsonapi.dumps(None)])
-			else:
-				# keep worker (mark as ready)
-				self.ready.put(worker)
+				self.workers.send_multipart([worker, '', default.dumps(None)])
+				self.counters['retired'] += 1
+
+				# killed workers exit asynchronously
+				stats['workers'] -= 1
+				stats['ready'] -= 1
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class ScalingPolicy(object):
+	""" Decides when the rpc broker spawns and retires workers
+
+	Subclass and override spawn/retire for custom policies. Both receive
+	the broker stats (workers, ready, busy, starting, queued, wait, ...).
+	"""
+
+	def __init__(self, min_workers=1, max_workers=64, idle_timeout=10, queue_target=0, latency_target=None):
+		self.min_workers    = min_workers
+		self.max_workers    = max_workers
+		self.idle_timeout   = idle_timeout   # seconds a surplus worker stays idle before retiring
+		self.queue_target   = queue_target   # queued requests tolerated before spawning
+		self.latency_target = latency_target # average queue wait (seconds) that triggers spawning
+
+	def spawn(self, stats):
+		""" Spawn an additional worker for the queued requests? """
+		if stats['workers'] >= self.max_workers:
+			return False
+
+		# idle and starting workers will pick up part of the queue
+		queued = stats['queued'] - stats['ready'] - stats['starting']
+
+		if queued > self.queue_target:
+			return True
+
+		return queued > 0 and self.latency_target is not None and stats['wait'] > self.latency_target
+
+	def retire(self, idle, stats):
+		""" Retire a worker that has been idle for idle seconds? """
+		return stats['workers'] > self.min_workers and idle >= self.idle_timeout
+
+
+class FixedPolicy(ScalingPolicy):
+	""" Fixed number of workers (e.g. pre-forked processes) """
+
+	def __init__(self, workers):
+		super(FixedPolicy, self).__init__(workers, workers)
+
+	def spawn(self, stats):
+		return False
+
+	def retire(self, idle, stats):
+		return False
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import itertools
+import mmap
+import os
+import os.path as osp
+import time
+
+import gevent
+
+
+class Segments(object):
+	""" Large results for same-host callers, passed as mmap'ed files instead of messages """
+
+	def __init__(self, name, path='tmp/shm', threshold=1 << 20, ttl=60):
+		self.name      = name
+		self.path      = path
+		self.threshold = threshold # smaller payloads go through the socket
+		self.ttl       = ttl       # segments never attached are removed after ttl seconds
+
+		self.ids = itertools.count()
+
+		if not osp.isdir(path):
+			os.makedirs(path)
+
+	def write(self, data):
+		""" Store data in a new segment, return its path """
+		path = osp.join(self.path, '%s-%d-%d' % (self.name, os.getpid(), next(self.ids)))
+
+		# readers never see partial segments
+		with open(path + '.tmp', 'wb') as f:
+			f.write(data)
+		os.rename(path + '.tmp', path)
+
+		return path
+
+	def sweep(self):
+		""" Remove segments of callers that gave up """
+		while True:
+			gevent.sleep(self.ttl / 2.)
+
+			for path in glob.glob(osp.join(self.path, '%s-%d-*' % (self.name, os.getpid()))):
+				try:
+					if os.stat(path).st_mtime + self.ttl < time.time():
+						os.remove(path)
+				except OSError:
+					continue
+
+
+def attach(path):
+	""" Map a segment as a read-only buffer
+
+	The file is unlinked right away, its memory is released once the buffer
+	(and every slice of it) is garbage collected.
+	"""
+	with open(path, 'rb') as f:
+		mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	os.remove(path)
+
+	return buffer(mapped)
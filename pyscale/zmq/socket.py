@@ -4,12 +4,27 @@
 import logging
 import re
 import glob
+import time
 import os.path as osp
 from contextlib import contextmanager
 
+import gevent
+from gevent.event import AsyncResult
 from gevent_zeromq import zmq
-from .common import patterns, format_method
-from ..lib import ReqError
+
+from .common import patterns, Chain, pack_header, parse_header, spawn
+from .codec import default, get_codec, choose_codec
+from . import compress
+from .pool import SocketPool
+from .discovery import registry
+from .shm import attach
+from .tracing import new_id
+from ..lib import ReqError, OverloadError, DeadlineError
+from ..lib.decorators import Cache
+
+
+class Expired(Exception):
+	pass
 
 
 class ProxySocket(object):
@@ -17,7 +32,7 @@ class ProxySocket(object):
 
 	def __init__(self, obj, parsed=[]):
 		self._obj = obj
-		self._parsed = []
+		self._parsed = list(parsed)
 
 		self._str = None
 
@@ -64,28 +79,52 @@ class ProxySocket(object):
 		else:
 			raise ValueError('Unknown value for attr: %s' % self.attr)
 
-		self._parsed.append(blob)
+		parsed = self._parsed + [blob]
+
+		# async mode: attributes are chained locally and sent when called
+		if self._obj._async and self._attr not in ('dir', 'len'):
+			if self._attr is 'get':
+				return ProxySocket(self._obj, parsed)
+
+			return self._obj._send_async(parsed, lambda reply: self._reply(reply, parsed))
 
 		# make request
 		if self._obj._sock is not None:
-			reply = self._obj._send(self._parsed)
+			reply = self._obj._send(parsed)
 		else:
 			with self._obj:
-				reply = self._obj._send(self._parsed)
+				reply = self._obj._send(parsed)
+
+		return self._reply(reply, parsed)
 
+	def _reply(self, reply, parsed):
 		# parse response
 		if 'error' in reply:
+			if reply.get('overloaded'):
+				return OverloadError(reply['error'])
+			elif reply.get('expired'):
+				return DeadlineError(reply['error'])
+
 			return ReqError(reply['error'])
 		elif 'proxy' in reply:
-			self._str = '(proxy: %s)' % reply['proxy']
-			return self
+			if reply.get('stream'):
+				sock = self._obj if isinstance(self._obj, Socket) else self._obj._sock
+				return Stream(sock, reply['handle'], reply['proxy'])
+
+			if 'handle' in reply:
+				# continue from the remote object instead of replaying the chain
+				parsed = [('__handle', [reply['handle']], {})]
+
+			proxy = ProxySocket(self._obj, parsed)
+			proxy._str = '(proxy: %s)' % reply['proxy']
+			return proxy
+		elif 'shm' in reply:
+			return attach(reply['shm'])
 		elif 'result' in reply:
 			return reply['result']
 		else:
 			raise ValueError('reply must be result, proxy or error')
 
-		return result
-
 	def __str__(self):
 		if self._str is None:
 			return super(ProxySocket, self).__str__()
@@ -107,35 +146,171 @@ class ProxySocket(object):
 		return self._rpc()
 
 
+class Stream(object):
+	""" Iterator returned by a module method, fetched in chunks of up to chunk items
+
+	The next chunk is requested while the current one is consumed, so at most
+	two chunks are buffered on the client and the module keeps only the iterator.
+	"""
+
+	def __init__(self, sock, handle, name, chunk=256):
+		self._sock   = sock
+		self._handle = handle
+		self._name   = name
+		self._chunk  = chunk
+
+		self._items = []
+		self._next  = spawn(self._fetch)
+
+	def _fetch(self):
+		reply = self._sock._request([('__handle', [self._handle], {}), ('__next', [self._chunk], {})])
+		return ProxySocket(self._sock)._reply(reply, [])
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		while not self._items:
+			if self._next is None:
+				raise StopIteration
+
+			items = self._next.get()
+			if isinstance(items, ReqError):
+				self._next = None
+				raise items
+
+			# prefetch unless the module ran out of items
+			self._next = spawn(self._fetch) if len(items) == self._chunk else None
+			self._items = items[::-1]
+
+		return self._items.pop()
+
+	def __repr__(self):
+		return '(stream: %s)' % self._name
+
+
+class Batch(object):
+	""" Collects independent calls and sends them in a single request """
+	_async = True
+
+	def __init__(self, sock):
+		self._sock  = sock
+		self._calls = []
+
+	def __getattr__(self, key):
+		return getattr(ProxySocket(self), key)
+
+	def _send_async(self, blob, parse):
+		result = AsyncResult()
+		self._calls.append((list(blob), parse, result))
+		return result
+
+	def _flush(self):
+		calls, self._calls = self._calls, []
+		if not calls:
+			return
+
+		blob = [('__batch', [[call[0] for call in calls]], {})]
+
+		def dispatch(reply):
+			if 'result' in reply:
+				replies = reply['result']
+			else:
+				# the whole batch failed (e.g. server without batch support)
+				replies = [reply] * len(calls)
+
+			for (chain, parse, result), item in zip(calls, replies):
+				result.set(parse(item))
+
+		if self._sock._async:
+			self._sock._send_async(blob, dispatch)
+		else:
+			dispatch(self._sock._request(blob))
+
+
+class CachedMethod(object):
+	""" @cached module method served from the client cache """
+
+	def __init__(self, sock, cache, method):
+		self._sock   = sock
+		self._cache  = cache
+		self._method = method
+
+	def __call__(self, *args, **kwargs):
+		key = Cache.key(args, kwargs)
+		entry = self._cache.get(self._method, key)
+
+		if entry is not None:
+			if not self._sock._async:
+				return entry[0]
+
+			result = AsyncResult()
+			result.set(entry[0])
+			return result
+
+		blob = [('__getattribute__', [self._method], {}), ('__call__', args, kwargs)]
+		generation = self._cache.generation
+
+		def parse(reply):
+			if 'result' in reply and key is not None:
+				self._cache.put(self._method, key, generation, reply['result'])
+
+			return ProxySocket(self._sock)._reply(reply, blob)
+
+		if self._sock._async:
+			return self._sock._send_async(blob, parse)
+		elif self._sock._sock is not None:
+			return parse(self._sock._send(blob))
+		else:
+			return parse(self._sock._request(blob))
+
+
 class Socket(object):
 	""" ZMQ client for all messaging patterns """
-	reserved = ['_name', '_type', '_pattern', '_subscription', '_context', '_sock_file', '_sock']
+	reserved = ['_name', '_type', '_pattern', '_subscription', '_context', '_async', '_timeout', '_priority', '_cache',
+		'_pool', '_sock_file', '_sock']
 
-	def __init__(self, name, _type='REQ', subscription='', context=None):
+	def __init__(self, name, _type='REQ', subscription='', context=None, async=False, timeout=None, priority=0,
+			cache=False):
 		self._name          = name
 		self._type          = _type.upper()
 		self._pattern       = patterns[self._type]
 		self._subscription  = subscription
 		self._context       = context or zmq.Context.instance()
+		self._async         = async
+		self._timeout       = timeout
+		self._priority      = priority
+		self._cache         = cache
+		self._pool          = SocketPool.instance(self._context)
 
+		# local ipc socket, or one of the hosts advertising the module
 		self._sock_file = "ipc://tmp/sockets/%s/%s.sock" % (self._pattern, self._name)
+		if self._pattern == 'rpc':
+			self._sock_file = registry.resolve(self._name, self._sock_file)
 		self._sock = None
 
 	def _open(self):
 		if self._sock is not None:
 			return
 
-		self._sock = self._context.socket(getattr(zmq, self._type))
-		self._sock.connect(self._sock_file)
-
 		if self._pattern == 'pub':
+			# subscriptions can't be shared
+			self._sock = self._context.socket(getattr(zmq, self._type))
+			self._sock.connect(self._sock_file)
 			self._sock.setsockopt(zmq.SUBSCRIBE, self._subscription)
+		else:
+			self._sock = self._pool.acquire((self._name, self._type), self._sock_file)
 
 		return self
 
-	def _close(self):
+	def _close(self, healthy=True):
 		if self._sock is not None:
-			self._sock.close()
+			if self._pattern == 'pub':
+				self._sock.close()
+			else:
+				# sockets interrupted mid-request can't be reused
+				self._pool.release((self._name, self._type), self._sock_file, self._sock, healthy)
+
 			self._sock = None
 
 		return self
@@ -144,15 +319,157 @@ class Socket(object):
 		return self._open()
 
 	def __exit__(self, type, value, trace):
-		self._close()
+		self._close(healthy=type is None)
+
+	def _deadline(self):
+		""" Earliest of our timeout and the deadline of the request being served """
+		deadline = getattr(gevent.getcurrent(), 'deadline', None)
+
+		if self._timeout is not None:
+			timeout = time.time() + self._timeout
+			deadline = timeout if deadline is None else min(deadline, timeout)
+
+		return deadline
+
+	def _codec(self, deadline=None):
+		codecs = self._pool.codecs
+
+		if self._sock_file not in codecs:
+			# servers advertise their codecs (legacy servers reply with an error)
+			self._sock.send(default.dumps([('__codecs', [], {})]))
+			reply = self._recv(deadline)
+
+			if 'result' in reply:
+				codecs[self._sock_file] = choose_codec(reply['result'])
+				self._pool.compressors[self._sock_file] = compress.choose_compressor(reply['result'])
+			else:
+				codecs[self._sock_file] = None
+
+		return codecs[self._sock_file]
 
 	def _send(self, blob):
-		self._sock.send_json(blob)
-		logging.debug("[zmq] ~> %s%s" % (self._name, ''.join([format_method(*req) for req in blob])))
-		return self._sock.recv_json()
+		expired = {'error': '%s: deadline exceeded' % self._name, 'expired': True}
+
+		deadline = self._deadline()
+		if deadline is not None and deadline <= time.time():
+			return expired
+
+		try:
+			codec = self._codec(deadline)
+			if codec is None:
+				self._sock.send(default.dumps(blob))
+			else:
+				self._sock.send_multipart(self._pack(codec, blob, deadline))
+
+			logging.debug("[zmq] ~> %s", Chain(self._name, blob))
+			return self._recv(deadline)
+		except Expired:
+			# REQ sockets still waiting for a reply can't be reused
+			self._close(healthy=False)
+			return expired
+
+	def _pack(self, codec, blob, deadline=None, **fields):
+		""" Request frames: [header][payload] """
+		payload = codec.dumps(blob)
+
+		if not self._sock_file.startswith('ipc://'):
+			# large requests to other hosts are compressed, replies may be as well
+			compressor = self._pool.compressors.get(self._sock_file)
+			if compressor is not None and len(payload) >= compress.threshold:
+				payload = compressor.compress(payload)
+				fields['z'] = compressor.name
+
+			fields['c'] = compress.accepted()
+
+		if deadline is not None:
+			# servers drop requests whose caller gave up
+			fields['d'] = '%.3f' % max(deadline - time.time(), 0)
+
+		if self._priority:
+			fields['p'] = self._priority
+
+		trace = getattr(gevent.getcurrent(), 'trace', None)
+		if trace is not None:
+			# trace:span:parent span (empty for the root)
+			fields['t'] = '%s:%s:%s' % (trace[0], new_id(), trace[1] or '')
+
+		if self._sock_file.startswith('ipc://'):
+			# we can map large results from shared memory
+			fields['m'] = 1
+
+		return [pack_header(codec.name, **fields), payload]
+
+	def _recv(self, deadline=None):
+		# reply: [header][reply] or [reply] (legacy json)
+		if deadline is not None and not self._sock.poll(max(deadline - time.time(), 0) * 1000):
+			raise Expired()
+
+		msg = self._sock.recv_multipart()
+		reply = msg.pop()
+
+		if not msg:
+			return default.loads(reply)
+
+		name, fields = parse_header(msg[0])
+		if 'z' in fields:
+			reply = compress.get_compressor(fields['z']).decompress(reply)
+
+		return get_codec(name).loads(reply)
+
+	def _send_async(self, blob, parse):
+		self._pool.check(self._sock_file)
+
+		if self._sock_file not in self._pool.codecs:
+			with self._clone() as sock:
+				try: sock._codec(sock._deadline())
+				except Expired:
+					sock._close(healthy=False)
+
+		codec = self._pool.codecs.get(self._sock_file)
+		if codec is None:
+			# legacy servers can't match replies out of order: one request per greenlet
+			return spawn(lambda: parse(self._request(blob)))
+
+		return self._pool.pipeline(self._name, self._sock_file, codec).send(blob, parse, self._deadline(), self._pack)
+
+	def _request(self, blob):
+		""" Synchronous request on a private socket """
+		with self._clone() as sock:
+			return sock._send(blob)
+
+	def _clone(self):
+		return Socket(self._name, self._type, self._subscription, self._context, timeout=self._timeout, priority=self._priority)
+
+	def _read_through(self):
+		""" Client cache of the module (None for remote modules and modules without @cached methods) """
+		if self._pattern != 'rpc' or not self._sock_file.startswith('ipc://'):
+			# invalidations are published on the local host only
+			return None
+
+		self._pool.check(self._sock_file)
+		if self._sock_file not in self._pool.caches:
+			reply = self._request([('__cacheable', [], {})])
+			if reply.get('expired'):
+				return None
+
+			self._pool.cache(self._name, self._sock_file, reply.get('result'))
+
+		return self._pool.caches[self._sock_file]
+
+	@contextmanager
+	def _batch(self):
+		""" Collect calls (returning AsyncResults) and send them as one request """
+		batch = Batch(self)
+		yield batch
+		batch._flush()
 
 	# pass to proxy
 	def __getattr__(self, key):
+		if self._cache:
+			cache = self._read_through()
+			if cache is not None and key in cache.caches:
+				return CachedMethod(self, cache, key)
+
 		return getattr(ProxySocket(self), key)
 
 	def __setattr__(self, key, value):
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import random
+from contextlib import contextmanager
+
+import gevent
+
+
+def new_id():
+	return '%016x' % random.getrandbits(64)
+
+@contextmanager
+def trace(trace_id=None):
+	""" Trace the requests of the current greenlet and the modules they reach (yields the trace id)
+
+	View the call tree with: cake trace <id>
+	"""
+	current = gevent.getcurrent()
+	previous = getattr(current, 'trace', None)
+
+	# (trace, span of the caller)
+	current.trace = (trace_id or new_id(), None)
+	try:
+		yield current.trace[0]
+	finally:
+		current.trace = previous
+
+
+class Tracer(object):
+	""" Ring buffer of the spans of traced requests served by this process """
+
+	fields = ('trace', 'span', 'parent', 'module', 'method', 'start', 'duration', 'error')
+
+	def __init__(self, module, size=10000, sample=0.0):
+		self.module = module
+		self.sample = sample # fraction of untraced requests that start a trace
+
+		self.spans = collections.deque(maxlen=size)
+
+	def sampled(self):
+		return self.sample and random.random() < self.sample
+
+	def record(self, trace, span, parent, method, start, duration, error=False):
+		self.spans.append((trace, span, parent, self.module, method, start, duration, error))
+
+	def find(self, trace=None, limit=20):
+		""" Spans of trace, or the most recent spans that started a trace """
+		if trace is not None:
+			spans = [span for span in self.spans if span[0] == trace]
+		else:
+			spans = [span for span in reversed(self.spans) if span[2] is None][:limit]
+
+		return [dict(zip(self.fields, span)) for span in spans]